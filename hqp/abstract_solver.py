@@ -3,6 +3,11 @@ from scipy.optimize import fmin_slsqp
 from scipy.optimize import approx_fprime
 from scipy.optimize.slsqp import approx_jacobian
 from scipy.optimize import line_search
+from qpoases import PySQProblem as SQProblem
+from qpoases import PyOptions as Options
+from qpoases import PyPrintLevel as PrintLevel
+from qpoases import PyReturnValue
+from qpoases import PySolutionAnalysis as SolutionAnalysis
 
 import time
 
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+Block layout of the contact force inequalities and preallocated storage for the
+data whose size depends on the active contacts.
+
+Every contact owns a slice of the columns of the force vector and a slice of the
+rows of the force inequalities B_f*f + b_f >= 0, so that B_f is block diagonal.
+Adding or removing a contact only touches its own block (and shifts the blocks
+that follow it), rather than recomputing the inequalities of all the contacts.
+"""
+
+import numpy as np
+import numpy.matlib
+
+
+class ContactBlockLayout(object):
+
+    names = [];     # names of the contacts, in the order of their blocks
+    dims = [];      # number of force variables of each contact
+    m_ins = [];     # number of force inequalities of each contact
+
+    ''' Constructor.
+        @param k_capacity Initial number of force variables that can be stored without reallocation
+        @param m_capacity Initial number of force inequalities that can be stored without reallocation
+    '''
+    def __init__(self, k_capacity=12, m_capacity=32):
+        self.names = [];
+        self.dims = [];
+        self.m_ins = [];
+        self.k = 0;     # number of force variables
+        self.m = 0;     # number of force inequalities
+        self._Bf = np.matlib.zeros((m_capacity, k_capacity));
+        self._bf = np.matlib.zeros((m_capacity, 1));
+        self._buffers = {};
+
+    @property
+    def Bf(self):
+        return self._Bf[:self.m,:self.k];
+
+    @property
+    def bf(self):
+        return self._bf[:self.m];
+
+    def exists(self, name):
+        return name in self.names;
+
+    def index(self, name):
+        if(name not in self.names):
+            raise ValueError("[ContactBlockLayout] ERROR: contact %s does not exist!" % name);
+        return self.names.index(name);
+
+    ''' Return the slice of the force vector associated to the specified contact. '''
+    def colSlice(self, name):
+        i = self.index(name);
+        c0 = int(np.sum(self.dims[:i]));
+        return slice(c0, c0+self.dims[i]);
+
+    ''' Return the slice of the force inequalities associated to the specified contact. '''
+    def rowSlice(self, name):
+        i = self.index(name);
+        r0 = int(np.sum(self.m_ins[:i]));
+        return slice(r0, r0+self.m_ins[i]);
+
+    ''' Append a contact block.
+        @param name Name of the contact
+        @param Bf_i An m_i x dim matrix of force inequalities of the contact
+        @param bf_i An m_i vector such that Bf_i*f_i + bf_i >= 0
+    '''
+    def addBlock(self, name, Bf_i, bf_i):
+        if(name in self.names):
+            raise ValueError("[ContactBlockLayout] ERROR: contact %s already exists!" % name);
+        (m_i, dim) = Bf_i.shape;
+        self._reserve(self.m+m_i, self.k+dim);
+        self._Bf[self.m:self.m+m_i, self.k:self.k+dim] = Bf_i;
+        self._bf[self.m:self.m+m_i] = np.asmatrix(bf_i).reshape((m_i,1));
+        self.names += [name];
+        self.dims += [dim];
+        self.m_ins += [m_i];
+        self.k += dim;
+        self.m += m_i;
+
+    ''' Overwrite the inequalities of an existing contact, which must keep the same size. '''
+    def updateBlock(self, name, Bf_i, bf_i):
+        rows = self.rowSlice(name);
+        cols = self.colSlice(name);
+        assert Bf_i.shape==(rows.stop-rows.start, cols.stop-cols.start), "Contact block cannot change size"
+        self._Bf[rows, cols] = Bf_i;
+        self._bf[rows] = np.asmatrix(bf_i).reshape((rows.stop-rows.start,1));
+
+    ''' Remove a contact block, shifting up and left the blocks that follow it. '''
+    def removeBlock(self, name):
+        rows = self.rowSlice(name);
+        cols = self.colSlice(name);
+        i = self.index(name);
+        m_i = self.m_ins[i];
+        dim = self.dims[i];
+        self._Bf[rows.start:self.m-m_i, cols.start:self.k-dim] = self._Bf[rows.stop:self.m, cols.stop:self.k];
+        self._bf[rows.start:self.m-m_i] = self._bf[rows.stop:self.m];
+        self._Bf[self.m-m_i:self.m, :self.k] = 0.0;
+        self._Bf[:self.m, self.k-dim:self.k] = 0.0;
+        self._bf[self.m-m_i:self.m] = 0.0;
+        del self.names[i];
+        del self.dims[i];
+        del self.m_ins[i];
+        self.k -= dim;
+        self.m -= m_i;
+
+    ''' Return a rows x cols view on a preallocated matrix identified by name.
+        The storage is a flat array whose leading rows*cols entries are reshaped into the
+        view, so that the view is always C-contiguous and can be handed directly to solvers
+        that read the raw data. The storage is reallocated (doubling its size) only when its
+        capacity is exceeded, so that contact switches do not allocate new memory.
+        The view is set to zero unless zero is False (e.g. when it is fully overwritten anyway);
+        its content is preserved only if its shape did not change since the last call.
+    '''
+    def buffer(self, name, rows, cols, zero=True):
+        rows = int(rows);
+        cols = int(cols);
+        buf = self._buffers.get(name, None);
+        if(buf is None or buf.size<rows*cols):
+            old = 0 if buf is None else buf.size;
+            buf = np.zeros(max(rows*cols, 2*old));
+            self._buffers[name] = buf;
+        view = np.asmatrix(buf[:rows*cols].reshape((rows,cols)));
+        if(zero):
+            view[:,:] = 0.0;
+        return view;
+
+    def _reserve(self, m, k):
+        if(m<=self._Bf.shape[0] and k<=self._Bf.shape[1]):
+            return;
+        Bf = np.matlib.zeros((max(m, 2*self._Bf.shape[0]), max(k, 2*self._Bf.shape[1])));
+        bf = np.matlib.zeros((Bf.shape[0], 1));
+        Bf[:self.m,:self.k] = self._Bf[:self.m,:self.k];
+        bf[:self.m] = self._bf[:self.m];
+        self._Bf = Bf;
+        self._bf = bf;
@@ -86,3 +86,62 @@ def computeSecondOrderPolynomialFitting(x, dt, window_length):
         ddx[:,t] = 2.0*abc[0,:].T;
         
     return (xp, dx, ddx)
+
+
+''' Online version of computeSecondOrderPolynomialFitting: estimate the value and the first two
+    derivatives of a signal, one sample at a time, by fitting a second-order polynomial to
+    the last window_length samples. The least-squares fit is a fixed linear kernel of the
+    window, so it is computed once in the constructor and each new sample costs
+    O(window_length*N), for all the N components of the signal at once.
+    The estimates refer to the center of the window, i.e. they are delayed by
+    0.5*(window_length-1)*dt.
+'''
+class StreamingPolynomialFitting(object):
+
+    ''' Constructor.
+        @param dt The duration of the time step in seconds
+        @param window_length An positive odd integer (>=3) representing the length of the sliding window
+        @param x0 The initial value of the signal, used to fill the window
+    '''
+    def __init__(self, dt, window_length, x0):
+        assert dt>0.0, "dt must be positive"
+        assert window_length>2, "window length must be at least 3"
+        assert window_length%2==1, "window length must be an odd number"
+        self.dt = dt;
+        self.w = window_length;
+        wh = int(floor(0.5*(window_length-1)));
+        # fit x(t) = a*t^2 + b*t + c on the window and evaluate it at its center
+        A = np.empty((self.w,3));
+        A[:,2] = 1.0;
+        A[:,1] = dt * np.arange(self.w);
+        A[:,0] = np.square(A[:,1]);
+        abc = np.linalg.pinv(A);    # 3 x w, rows map the window to a, b, c
+        t_c = dt*wh;
+        kernel = np.array([np.dot(A[wh,:], abc),                    # x(t_c)
+                           2.0*t_c*abc[0,:] + abc[1,:],             # dx(t_c)
+                           2.0*abc[0,:]]);                          # ddx(t_c)
+        # the samples are stored in a ring buffer, so precompute the kernel for each position
+        # of the most recent sample: column j of the window is the sample of age (i-j)%w
+        self.kernels = np.empty((self.w, self.w, 3));
+        ages = np.arange(self.w);
+        for i in range(self.w):
+            self.kernels[i] = kernel[:, self.w-1-((i-ages)%self.w)].T;
+        self.reset(x0);
+
+    def reset(self, x0):
+        x0 = np.asarray(x0, dtype=float).reshape(-1);
+        self.X = np.tile(x0.reshape((-1,1)), (1,self.w));  # N x w ring buffer of samples
+        self.i = self.w-1;                                  # index of the most recent sample
+        self.x = np.copy(x0);
+        self.dx = np.zeros(x0.shape[0]);
+        self.ddx = np.zeros(x0.shape[0]);
+
+    ''' Add a new sample and return the estimated (x, dx, ddx), as three arrays of size N. '''
+    def filter_data(self, x):
+        self.i = (self.i+1) % self.w;
+        self.X[:,self.i] = np.asarray(x).reshape(-1);
+        res = np.dot(self.X, self.kernels[self.i]);
+        self.x = res[:,0];
+        self.dx = res[:,1];
+        self.ddx = res[:,2];
+        return (self.x, self.dx, self.ddx);
@@ -6,7 +6,6 @@ Created on Wed Sep 23 09:44:07 2015
 
 from math import pi
 import numpy as np
-import matplotlib.pyplot as plt
 
 class FirstOrderLowPassFilter(object):
     Ts = 0.001; # sampling period
@@ -31,6 +30,7 @@ class FirstOrderLowPassFilter(object):
         
         
 if __name__=='__main__':
+    import matplotlib.pyplot as plt
     FC = 20;
     DT = 0.002;
     T = 50000;
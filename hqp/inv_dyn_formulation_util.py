@@ -1,5 +1,9 @@
 import numpy as np
+import time
+from collections import OrderedDict
+from copy import deepcopy
 from numpy.linalg import norm
+from scipy.linalg import cholesky, cho_solve, solve_triangular, qr
 from numpy.random import random
 from polytope_conversion_utils import cone_span_to_face
 from hqp.wrapper import Wrapper
@@ -8,6 +12,9 @@ from pinocchio.utils import zero as zeros
 from acc_bounds_util_multi_dof import computeAccLimits
 from sot_utils import compute6dContactInequalities, crossMatrix
 from first_order_low_pass_filter import FirstOrderLowPassFilter
+from derivative_filters import StreamingPolynomialFitting
+from contact_layout_util import ContactBlockLayout
+from standard_qp_solver import StandardQpSolver
 from convex_hull_util import compute_convex_hull, plot_convex_hull
 from geom_utils import plot_polytope
 from multi_contact.utils import compute_GIWC, compute_support_polygon
@@ -22,13 +29,59 @@ class InvDynFormulation (object):
     ENABLE_CAPTURE_POINT_LIMITS = False;
     ENABLE_TORQUE_LIMITS        = True;
     ENABLE_FORCE_LIMITS         = True;
-    
+
+    IMPOSE_POSITION_BOUNDS      = True;     # joint limits used by createJointAccInequalitiesViability,
+    IMPOSE_VELOCITY_BOUNDS      = True;     # see enableJointLimits
+    IMPOSE_VIABILITY_BOUNDS     = True;
+    IMPOSE_ACCELERATION_BOUNDS  = True;
+
     USE_JOINT_VELOCITY_ESTIMATOR = False;
     BASE_VEL_FILTER_CUT_FREQ = 5;
-    JOINT_VEL_ESTIMATOR_DELAY = 0.02;
+    JOINT_VEL_ESTIMATOR_DELAY = 0.02;   # delay of the joint velocity estimates (half of the fitting window)
+    estimator = None;                   # joint velocity estimator
     
     ACCOUNT_FOR_ROTOR_INERTIAS = True;
     
+    ''' Method used to compute the mapping y = C*tau + c:
+            'cholesky'  eliminate dv and f through a Cholesky factorization of M and of Jc*M^-1*Jc^T
+            'projected' project the dynamics onto the null space of the contact constraints through
+                        a QR decomposition of Jc^T, so that M is never factorized nor inverted
+            'direct'    do not compute C and c: the QP is solved in x=[dv, f], with the dynamics and
+                        the contact constraints as equalities and the torque limits as linear inequalities
+    '''
+    DYNAMICS_FORMULATION = 'cholesky';
+    DYNAMICS_FORMULATIONS = ('cholesky', 'projected', 'direct');
+    QR_RANK_THR = 1e-8;  # min abs value on the diagonal of R for Jc to be considered full rank
+    DIRECT_FORCE_REGULARIZATION = 1e-4; # weight of the contact force regularization in the direct formulation
+    
+    ''' Multi-rate update of the dynamics: M, its factorization, Lambda_c and C are recomputed
+        every DYNAMICS_UPDATE_PERIOD calls to setNewSensorData, or earlier if the joint configuration
+        moved by more than DYNAMICS_UPDATE_DQ_THR since their last update. The kinematics, the
+        contact Jacobians, h and c are updated at every call.
+    '''
+    DYNAMICS_UPDATE_PERIOD = 1;     # 1 means that the dynamics is recomputed at every call
+    DYNAMICS_UPDATE_DQ_THR = 1e-2;  # max norm of the joint part of q - q_dynamics_update before forcing an update
+    q_dynamics_update = None;       # configuration at the last update of the dynamics
+    dynamics_staleness_ticks = 0;   # number of calls to setNewSensorData since the last update of the dynamics
+    dynamics_staleness_dq = 0.0;    # norm of the joint part of q - q_dynamics_update
+    
+    STEP_SOLVER = 'qpoases';        # type of solver used by step
+    STEP_TIMING_BUFFER_SIZE = 1000; # number of calls to step whose timings are stored
+    STEP_TIMING_STAGES = ('sensor data', 'cost function', 'constraints', 'qp', 'solution', 'total');
+    solver = None;      # StandardQpSolver used by step
+    x_prev = None;      # last solution of the QP, used as warm start by step
+    step_times = None;  # ring buffer with the timings of the stages of step
+    step_index = 0;     # number of calls to step
+    
+    contact_modes = None;   # registered contact modes: name -> dict with precomputed data, solver and warm start
+    contact_mode = None;    # name of the active contact mode (None if contacts were added/removed one by one)
+    CONTACT_MODE_DATA = ('rigidContactConstraints', 'rigidContactConstraints_p', 'rigidContactConstraints_N',
+                         'rigidContactConstraints_fMin', 'rigidContactConstraints_mu', 'rigidContactConstraints_m_in',
+                         'contactLayout', 'k', 'm_in', 'm_f', 'n_qp', 'm_qp', 'ind_force_in', 'ind_acc_in', 'ind_cp_in',
+                         'lb', 'ub', 'B', 'b', 'Jc', 'dJc_v', 'dx_c', 'ddx_c_des', 'Jc_Minv', 'Jc_T_pinv',
+                         'C', 'c', 'G', 'glb', 'gub', 'A_x', 'lbA_x', 'ubA_x', 'B_sp', 'b_sp', 'contact_points', 'contact_normals',
+                         'support_polygon_computed'); # attributes that depend on the active contacts
+    
     JOINT_FRICTION_COMPENSATION_PERCENTAGE = 1.0;
     MAX_JOINT_ACC = 100.0;      # maximum acceleration upper bound
     MAX_MIN_JOINT_ACC = 10.0;   # maximum acceleration lower bound
@@ -39,7 +92,10 @@ class InvDynFormulation (object):
     nq=0;    # number of position DoFs
     nv=0;   # number of velocity DoFs
     m_in=0; # number of inequalities
+    m_f=0;  # number of contact force inequalities (the first m_f inequalities)
     k=0;    # number of contact constraints (i.e. size of contact force vector)
+    n_qp=0; # number of variables of the QP passed to the solver
+    m_qp=0; # number of linear constraints of the QP passed to the solver
     
     ind_force_in = [];  # indeces of force inequalities
     ind_acc_in = [];    # indeces of acceleration inequalities
@@ -60,7 +116,9 @@ class InvDynFormulation (object):
             minimize    ||A*y-a||^2
             subject to  B*y+b >= 0
                         dynamics(y) = 0
-        where y=[dv, f, tau]
+        where y=[dv, f, tau]. Only the inequalities that do not involve f (joint acceleration and
+        capture point limits) are stored in B and b, as B*dv+b >= 0; the contact force inequalities
+        are the blocks of contactLayout.
     '''
     A = [];
     a = [];
@@ -81,6 +139,19 @@ class InvDynFormulation (object):
     G = [];
     g = [];
     
+    ''' Direct formulation of the inverse dynamics optimization problem
+        in terms of x = [dv, f]:
+            minimize    ||D*x-d||^2
+            subject to  lbA <= A_x*x <= ubA
+        where the rows of A_x are, in this order: the inequalities on [dv, f],
+        the nv rows of the dynamics M*dv - Jc^T*f (equalities on the
+        unactuated DoFs, torque limits on the actuated ones) and the k rows
+        of the contact constraints Jc*dv (equalities).
+    '''
+    A_x = [];
+    lbA_x = [];
+    ubA_x = [];
+    
     M = [];         # mass matrix
     h = [];         # dynamic drift
     q = [];
@@ -96,11 +167,13 @@ class InvDynFormulation (object):
     x_c = [];       # contact points
     dx_c = [];      # contact points velocities
     
-    Minv = [];      # inverse of the mass matrix
+    M_chol = None;  # lower Cholesky factor L of Q2^T*M*Q2 = L*L^T in the projected formulation
+    M_ltl = None;   # lower triangular L such that M = L^T*L, with the sparsity of the kinematic tree
+    Minv_S_T = None;    # M^-1*S^T, computed with M_ltl and reused by contact switches (None when M has changed)
+    Jc_QR = None;   # (Q1, Q2, R) such that Jc^T = [Q1 Q2]*[R; 0], used by the projected formulation
     Jc_Minv = [];   # Jc*Minv
-    Lambda_c = [];  # task-space mass matrix (Jc*Minv*Jc^T)^-1
+    Lambda_c_chol = None;   # Cholesky factor of Jc*Minv*Jc^T, i.e. of the inverse of the task-space mass matrix Lambda_c
     Jc_T_pinv = []; # Lambda_c*Jc_Minv
-    Nc_T = [];      # I - Jc^T*Jc_T_pinv
     S_T = [];       # selection matrix
     dJc_v = [];     # product of contact Jacobian time derivative and velocity vector: dJc*v
     
@@ -111,6 +184,7 @@ class InvDynFormulation (object):
     rigidContactConstraints_mu = [];    # friction coefficients
     rigidContactConstraints_m_in = [];  # number of inequalities
     bilateralContactConstraints = [];
+    contactLayout = None;   # row/column layout of the contact force inequalities and preallocated buffers
 
     tasks = [];
     task_weights = [];
@@ -119,6 +193,10 @@ class InvDynFormulation (object):
     b_sp = None;
     support_polygon_computed = False;
     
+    SUPPORT_POLYGON_CACHE_SIZE = 16;    # max number of support polygons kept in cache (0 to disable the cache)
+    SUPPORT_POLYGON_CACHE_TOL = 1e-3;   # resolution used to quantize the contact frame poses in the cache keys
+    support_polygon_cache = None;       # (contact names, quantized contact poses) -> (B_sp, b_sp), least recently used first
+    
     contact_points = None;  # 3xN matrix containing the contact points in world frame
     contact_normals = None; # 3xN matrix containing the contact normals in world frame
 
@@ -127,30 +205,16 @@ class InvDynFormulation (object):
         self.updateSupportPolygon();
         
         self.m_in = 0;                              # number of inequalities
-        c = len(self.rigidContactConstraints);      # number of unilateral contacts
-        self.k = int(np.sum([con.dim for con in self.rigidContactConstraints]));
-        self.k += int(np.sum([con.dim for con in self.bilateralContactConstraints]));
+        L = self.contactLayout;                     # force inequalities of the unilateral contacts
+        self.k = L.k + int(np.sum([con.dim for con in self.bilateralContactConstraints]));
         if(self.ENABLE_FORCE_LIMITS):
-            self.rigidContactConstraints_m_in = np.zeros(c, np.int);
-            Bf = zeros((0,self.k));
-            bf = zeros(0);
-            ii = 0;
-            for i in range(c):
-                (Bfi, bfi) = self.createContactForceInequalities(self.rigidContactConstraints_fMin[i], self.rigidContactConstraints_mu[i], \
-                                                                 self.rigidContactConstraints_p[i], self.rigidContactConstraints_N[i], \
-                                                                 self.rigidContactConstraints[i].framePosition().rotation);
-                self.rigidContactConstraints_m_in[i] = Bfi.shape[0];
-                tmp = zeros((Bfi.shape[0], self.k));
-                dim = self.rigidContactConstraints[i].dim;
-                mask = self.rigidContactConstraints[i]._mask;
-                tmp[:,ii:ii+dim] = Bfi[:,mask];
-                ii += dim;
-                Bf = np.vstack((Bf, tmp));
-                bf = np.vstack((bf, bfi));
-            self.ind_force_in = range(self.m_in, self.m_in + np.sum(self.rigidContactConstraints_m_in));
-            self.m_in += np.sum(self.rigidContactConstraints_m_in);
+            self.rigidContactConstraints_m_in = np.array(L.m_ins, np.int);
+            self.ind_force_in = range(self.m_in, self.m_in + L.m);
+            self.m_in += L.m;
+            self.m_f = L.m;
         else:
             self.ind_force_in = [];
+            self.m_f = 0;
 
         if(self.ENABLE_JOINT_LIMITS):
             self.ind_acc_in = range(self.m_in, self.m_in+2*self.na);
@@ -171,23 +235,33 @@ class InvDynFormulation (object):
         else:
             self.ind_cp_in = [];
             
-        # resize all data that depends on k
-        self.B          = zeros((self.m_in, self.nv+self.k+self.na));
-        self.b          = zeros(self.m_in);
-        self.Jc         = zeros((self.k,self.nv));
-        self.dJc_v      = zeros(self.k);
-        self.dx_c       = zeros(self.k);
-        self.ddx_c_des  = zeros(self.k);
-        self.Jc_Minv    = zeros((self.k,self.nv));
-        self.Lambda_c   = zeros((self.k,self.k));
-        self.Jc_T_pinv  = zeros((self.k,self.nv));
-        self.C           = zeros((self.nv+self.k+self.na, self.na));
-        self.c           = zeros(self.nv+self.k+self.na);
-        
-        if(self.ENABLE_FORCE_LIMITS and self.k>0):
-            self.B[self.ind_force_in, self.nv:self.nv+self.k] = Bf;
-            self.b[self.ind_force_in] = bf;
-            #print "Contact inequality constraints:\n", self.B[self.ind_force_in, self.nv:self.nv+self.k], "\n", bf.T;
+        # resize all data that depends on k (views on preallocated buffers)
+        # B*dv + b >= 0 holds the inequalities m_f to m_in, which do not involve the contact forces,
+        # while the force inequalities are read from the blocks of contactLayout, so that adding or
+        # removing a contact only writes (or shifts) its own block
+        self.B          = L.buffer('B', self.m_in-self.m_f, self.nv);
+        self.b          = L.buffer('b', self.m_in-self.m_f, 1);
+        self.Jc         = L.buffer('Jc', self.k, self.nv);
+        self.dJc_v      = L.buffer('dJc_v', self.k, 1);
+        self.dx_c       = L.buffer('dx_c', self.k, 1);
+        self.ddx_c_des  = L.buffer('ddx_c_des', self.k, 1);
+        self.Jc_Minv    = L.buffer('Jc_Minv', self.k, self.nv);
+        self.Jc_T_pinv  = L.buffer('Jc_T_pinv', self.k, self.nv);
+        self.C          = L.buffer('C', self.nv+self.k+self.na, self.na);
+        self.c          = L.buffer('c', self.nv+self.k+self.na, 1);
+        if(self.DYNAMICS_FORMULATION=='direct'):
+            self.n_qp   = self.nv+self.k;
+            self.m_qp   = self.m_in+self.nv+self.k;
+            self.A_x    = L.buffer('A_x', self.m_qp, self.n_qp);
+            self.lbA_x  = L.buffer('lbA_x', self.m_qp, 1);
+            self.ubA_x  = L.buffer('ubA_x', self.m_qp, 1);
+        else:
+            self.n_qp   = self.na;
+            self.m_qp   = self.m_in;
+            self.G      = L.buffer('G', self.m_in, self.na, zero=False);
+            self.glb    = L.buffer('glb', self.m_in, 1, zero=False);
+            self.gub    = L.buffer('gub', self.m_in, 1, zero=False);
+            self.gub[:,:] = 1e10;
         
         if(updateConstrainedDynamics):
             self.updateConstrainedDynamics();
@@ -215,7 +289,6 @@ class InvDynFormulation (object):
             self.S_T[6:, :]  = np.matlib.eye(self.na);
         else:
             self.S_T    = np.matlib.eye(self.na);
-        self.Nc_T       = np.matlib.eye(self.nv);
     
         self.qMin       = self.r.model.lowerPositionLimit;
         self.qMax       = self.r.model.upperPositionLimit;
@@ -230,6 +303,11 @@ class InvDynFormulation (object):
             self.tauMax     = self.r.model.effortLimit;
                         
         self.contact_points = zeros((0,3));
+        self.contactLayout = ContactBlockLayout();
+        self.support_polygon_cache = OrderedDict();
+        self.step_times = np.zeros((self.STEP_TIMING_BUFFER_SIZE, len(self.STEP_TIMING_STAGES)));
+        self.step_index = 0;
+        self.contact_modes = {};
         self.updateInequalityData(updateConstrainedDynamics=False);
         self.setNewSensorData(0, q, v);        
         
@@ -243,6 +321,7 @@ class InvDynFormulation (object):
     ''' ********** ENABLE OR DISABLE CONTACT CONSTRAINTS ********** '''
 
     def removeUnilateralContactConstraint(self, constr_name):
+        self.detachContactMode();
         found = False;
         for i in range(len(self.rigidContactConstraints)):
             if(self.rigidContactConstraints[i].name==constr_name):
@@ -251,6 +330,7 @@ class InvDynFormulation (object):
                 del self.rigidContactConstraints_N[i];
                 del self.rigidContactConstraints_fMin[i];
                 del self.rigidContactConstraints_mu[i];
+                self.contactLayout.removeBlock(constr_name);
                 found = True;
                 break;
         if(found==False):
@@ -265,6 +345,9 @@ class InvDynFormulation (object):
         
         
     def addUnilateralContactConstraint(self, constr, contact_points, contact_normals, fMin, mu):
+        self.detachContactMode();
+        (Bf, bf) = self.createContactForceInequalities(fMin, mu, contact_points, contact_normals, constr.framePosition().rotation);
+        self.contactLayout.addBlock(constr.name, Bf[:,constr._mask], bf);
         self.rigidContactConstraints        += [constr];
         self.rigidContactConstraints_p      += [contact_points];
         self.rigidContactConstraints_N      += [contact_normals];
@@ -276,6 +359,98 @@ class InvDynFormulation (object):
         res = [c.name for c in self.rigidContactConstraints if c.name==constr_name];
         return True if len(res)>0 else False;
         
+    ''' ********** CONTACT MODES ********** '''
+    
+    ''' Register a contact mode, i.e. a set of unilateral contacts that is known in advance
+        (e.g. double support, left support, right support). The force inequalities in the
+        contact frames, the index layout and the buffers are created once here, so that
+        setContactMode can later switch to this mode by swapping references. The QP solver
+        of the mode is created by step the first time the mode is used.
+        @param name Name of the contact mode
+        @param contacts A list of tuples (constr, contact_points, contact_normals, fMin, mu)
+                        with the arguments of addUnilateralContactConstraint
+    '''
+    def registerContactMode(self, name, contacts):
+        current = self.storeContactData();
+        self.rigidContactConstraints        = [c[0] for c in contacts];
+        self.rigidContactConstraints_p      = [c[1] for c in contacts];
+        self.rigidContactConstraints_N      = [c[2] for c in contacts];
+        self.rigidContactConstraints_fMin   = [c[3] for c in contacts];
+        self.rigidContactConstraints_mu     = [c[4] for c in contacts];
+        self.contactLayout = ContactBlockLayout();
+        cones = [];
+        for (constr, P, N, fMin, mu) in contacts:
+            (Bf, bf) = self.createContactForceInequalities(fMin, mu, P, N);
+            cones += [(constr, Bf, bf, P.shape[1]>1)];
+            self.contactLayout.addBlock(constr.name, Bf[:,constr._mask], bf);
+        self.updateInequalityData(updateConstrainedDynamics=False);
+        self.contact_modes[name] = {'data':         self.storeContactData(),
+                                    'signature':    self.contactModeSignature(),
+                                    'cones':        cones,
+                                    'solver':       None,
+                                    'x_prev':       None};
+        self.restoreContactData(current);
+        
+    ''' Make the specified registered contact mode the active one. The solver used by step
+        and its warm start are swapped as well. The friction cones of the mode are rotated
+        into the current orientation of the contact frames. The precomputed data are rebuilt
+        only if the enabled constraints or the dynamics formulation changed since the mode
+        was registered.
+    '''
+    def setContactMode(self, name):
+        if(name not in self.contact_modes):
+            raise ValueError("[InvDynForm] ERROR: contact mode %s has not been registered!" % name);
+        if(name==self.contact_mode):
+            return;
+        if(self.contact_mode is not None):
+            self.contact_modes[self.contact_mode]['solver'] = self.solver;
+            self.contact_modes[self.contact_mode]['x_prev'] = self.x_prev;
+        mode = self.contact_modes[name];
+        self.restoreContactData(mode['data']);
+        self.solver = mode['solver'];
+        self.x_prev = mode['x_prev'];
+        self.contact_mode = name;
+        for (constr, Bf, bf, rotate) in mode['cones']:
+            if(rotate):
+                Bf = self.rotateContactForceInequalities(Bf, constr.framePosition().rotation);
+            self.contactLayout.updateBlock(constr.name, Bf[:,constr._mask], bf);
+        
+        self.updateSupportPolygon();
+        if(mode['signature']!=self.contactModeSignature() or 
+           (self.ENABLE_CAPTURE_POINT_LIMITS and self.b_sp.size!=len(self.ind_cp_in))):
+            self.updateInequalityData();
+            mode['data'] = self.storeContactData();
+            mode['signature'] = self.contactModeSignature();
+        else:
+            self.updateConstrainedDynamics();
+        
+    ''' Stop sharing the data of the active contact mode, so that contacts can be added or
+        removed without modifying the registered mode.
+    '''
+    def detachContactMode(self):
+        if(self.contact_mode is None):
+            return;
+        self.contact_modes[self.contact_mode]['solver'] = self.solver;
+        self.contact_modes[self.contact_mode]['x_prev'] = self.x_prev;
+        self.contact_mode = None;
+        self.solver = None;
+        self.contactLayout = deepcopy(self.contactLayout);
+        for name in ('rigidContactConstraints', 'rigidContactConstraints_p', 'rigidContactConstraints_N',
+                     'rigidContactConstraints_fMin', 'rigidContactConstraints_mu'):
+            setattr(self, name, list(getattr(self, name)));
+            
+    def storeContactData(self):
+        return dict([(name, getattr(self, name, None)) for name in self.CONTACT_MODE_DATA]);
+        
+    def restoreContactData(self, data):
+        for (name, value) in data.items():
+            setattr(self, name, value);
+            
+    def contactModeSignature(self):
+        return (self.ENABLE_FORCE_LIMITS, self.ENABLE_JOINT_LIMITS, self.ENABLE_TORQUE_LIMITS,
+                self.ENABLE_CAPTURE_POINT_LIMITS, self.DYNAMICS_FORMULATION,
+                tuple([c.name for c in self.bilateralContactConstraints]));
+        
     def addTask(self, task, weight):
         self.tasks        += [task];
         self.task_weights += [weight];
@@ -301,6 +476,7 @@ class InvDynFormulation (object):
             self.b_sp = zeros(0);
         else:
             i = 0;
+            key = [];
             for (constr, P, N, mu) in zip(self.rigidContactConstraints, self.rigidContactConstraints_p, 
                                           self.rigidContactConstraints_N, self.rigidContactConstraints_mu):
                 oMi = self.r.framePosition(constr._frame_id);
@@ -309,6 +485,15 @@ class InvDynFormulation (object):
                     self.contact_normals[:,i] = oMi.rotation * N[:,j];
                     mu_s[i,0] = mu[0];
                     i += 1;
+                if(self.SUPPORT_POLYGON_CACHE_SIZE>0):
+                    key += [(constr.name, mu[0], tuple(np.asarray(P).ravel()), tuple(np.asarray(N).ravel()), self.quantizePose(oMi))];
+            
+            key = tuple(key);
+            if(key in self.support_polygon_cache):
+                # move the entry to the end, so that the least recently used one is evicted first
+                (self.B_sp, self.b_sp) = self.support_polygon_cache[key] = self.support_polygon_cache.pop(key);
+                self.support_polygon_computed = True;
+                return;
             
             avg_z = np.mean(self.contact_points[2,:]);
             if(np.max(np.abs(self.contact_points[2,:] - avg_z)) < 1e-3):
@@ -330,7 +515,23 @@ class InvDynFormulation (object):
 #            self.plotSupportPolygon();
             self.B_sp = np.matrix(self.B_sp);
             self.b_sp = np.matrix(self.b_sp).T;
+            
+            if(self.SUPPORT_POLYGON_CACHE_SIZE>0):
+                if(len(self.support_polygon_cache)>=self.SUPPORT_POLYGON_CACHE_SIZE):
+                    self.support_polygon_cache.popitem(last=False);
+                self.support_polygon_cache[key] = (self.B_sp, self.b_sp);
         self.support_polygon_computed = True;
+        
+    ''' Quantize the translation and rotation of the specified SE3 placement on a grid of
+        resolution SUPPORT_POLYGON_CACHE_TOL, so that it can be used as a cache key.
+    '''
+    def quantizePose(self, M):
+        tol = self.SUPPORT_POLYGON_CACHE_TOL;
+        pose = np.vstack((M.translation, M.rotation.reshape((9,1))));
+        return tuple(np.round(np.asarray(pose).squeeze()/tol).astype(np.int64));
+    
+    def clearSupportPolygonCache(self):
+        self.support_polygon_cache.clear();
             
     ''' Get the matrix B and vector b representing the 2d support polygon as B*x+b>=0 '''
     def getSupportPolygon(self):
@@ -368,16 +569,24 @@ class InvDynFormulation (object):
     def enableCapturePointLimits(self, enable=True):
         self.ENABLE_CAPTURE_POINT_LIMITS = enable;
         self.updateInequalityData();
+        
+    def setDynamicsFormulation(self, formulation):
+        if(formulation not in self.DYNAMICS_FORMULATIONS):
+            raise ValueError("[InvDynForm] ERROR: dynamics formulation %s not recognized, use one of %s" % (formulation, self.DYNAMICS_FORMULATIONS));
+        self.DYNAMICS_FORMULATION = formulation;
+        self.updateInequalityData();
     
     ''' ********** SET ROBOT STATE ********** '''
     def setPositions(self, q, updateConstraintReference=True):
         self.q = np.matrix.copy(q);
         
+        if(self.USE_JOINT_VELOCITY_ESTIMATOR):
+            if(updateConstraintReference or self.estimator is None):
+                self.resetJointVelocityEstimator(q);
+            else:
+                self.estimator.filter_data(q[self.nq-self.na:]);
+        
         if(updateConstraintReference):
-            if(self.USE_JOINT_VELOCITY_ESTIMATOR):
-                raise Exception("Joint velocity estimator not implemented yet");
-                self.estimator.init(self.dt,self.JOINT_VEL_ESTIMATOR_DELAY,self.JOINT_VEL_ESTIMATOR_DELAY,self.JOINT_VEL_ESTIMATOR_DELAY,self.JOINT_VEL_ESTIMATOR_DELAY,True);
-                self.baseVelocityFilter = FirstOrderLowPassFilter(self.dt, self.BASE_VEL_FILTER_CUT_FREQ , np.zeros(6));
             self.r.forwardKinematics(q);
             for c in self.rigidContactConstraints:
                 Mref = self.r.position(q, c._link_id, update_geometry=False);
@@ -392,30 +601,56 @@ class InvDynFormulation (object):
             
         return self.q;
     
+    ''' Set the velocities. If USE_JOINT_VELOCITY_ESTIMATOR is true the joint velocities are
+        replaced by the estimates computed from the positions given to setPositions, and the
+        base velocities are low-pass filtered.
+    '''
     def setVelocities(self, v):
+        self.v = np.matrix.copy(v);
         if(self.USE_JOINT_VELOCITY_ESTIMATOR):
-            raise Exception("Joint velocity estimator not implemented yet");
-        else:
-            self.v = np.matrix.copy(v);
+            if(self.freeFlyer):
+                v_base = self.baseVelocityFilter.filter_data(np.asarray(v[:6]).squeeze());
+                self.v[:6] = np.asmatrix(v_base).reshape((6,1));
+            self.v[self.nv-self.na:] = np.asmatrix(self.estimator.dx).reshape((self.na,1));
         return self.v;
+    
+    ''' Create the joint velocity estimator and fill its window with the joint positions in q.
+        The window length is chosen so that the estimates are delayed by JOINT_VEL_ESTIMATOR_DELAY.
+        The estimator works on the joint coordinates, so all the actuated joints must have
+        as many position as velocity coordinates.
+    '''
+    def resetJointVelocityEstimator(self, q):
+        if(self.nq-self.na != (7 if self.freeFlyer else 0)):
+            raise ValueError("[InvDynForm] ERROR: joint velocity estimator requires one position coordinate per actuated joint");
+        wh = max(1, int(round(self.JOINT_VEL_ESTIMATOR_DELAY/self.dt)));
+        self.estimator = StreamingPolynomialFitting(self.dt, 2*wh+1, q[self.nq-self.na:]);
+        self.baseVelocityFilter = FirstOrderLowPassFilter(self.dt, self.BASE_VEL_FILTER_CUT_FREQ , np.zeros(6));
         
     def setNewSensorData(self, t, q, v):
         self.t = t;
         self.setPositions(q, updateConstraintReference=False);
         self.setVelocities(v);
         
-        #self.r.computeAllTerms(q, v);
-        self.r.update(q);
-        self.r.framesKinematics(q);
+        refresh = self.isDynamicsUpdateNeeded(q);
+        # every pinocchio algorithm runs at most once for this state, the tasks are served from the cache
+        self.r.setState(q, self.v);
+        self.r.require('kinematics', 'jacobians', 'frames', 'nle', 'com', 'Jcom');
+        if(refresh):
+            self.r.require('M');
         self.x_com    = self.r.com(q, update_kinematics=False);
         self.J_com    = self.r.Jcom(q, update_kinematics=False);
-        self.M        = self.r.mass(q, update_kinematics=False);
-        if(self.ACCOUNT_FOR_ROTOR_INERTIAS):
-            if(self.freeFlyer):
-                self.M[6:,6:]   += self.Md;
-            else:
-                self.M   += self.Md;
-        self.h        = self.r.bias(q,v, update_kinematics=False);
+        if(refresh):
+            self.M        = self.r.mass(q, update_kinematics=False).copy();
+            if(self.ACCOUNT_FOR_ROTOR_INERTIAS):
+                if(self.freeFlyer):
+                    self.M[6:,6:]   += self.Md;
+                else:
+                    self.M   += self.Md;
+            self.Minv_S_T = None;
+            self.q_dynamics_update = np.matrix.copy(q);
+            self.dynamics_staleness_ticks = 0;
+            self.dynamics_staleness_dq = 0.0;
+        self.h        = self.r.bias(q, self.v, update_kinematics=False);
 #        self.h          += self.JOINT_FRICTION_COMPENSATION_PERCENTAGE*np.dot(np.array(JOINT_VISCOUS_FRICTION), self.v);
         self.dx_com     = np.dot(self.J_com, self.v);
         com_z           = self.x_com[2]; #-np.mean(self.contact_points[:,2]);
@@ -423,41 +658,138 @@ class InvDynFormulation (object):
             self.cp         = self.x_com[:2] + self.dx_com[:2]/np.sqrt(9.81/com_z);
         else:
             self.cp = zeros(2);
-        self.updateConstrainedDynamics();
+        self.updateConstrainedDynamics(refresh);
         
-
-    def updateConstrainedDynamics(self):
+    ''' Decide whether the slowly varying dynamics quantities (M, its factorization, Lambda_c, C)
+        must be recomputed at this tick, and update the staleness metrics otherwise.
+        They are recomputed every DYNAMICS_UPDATE_PERIOD calls, or as soon as the joint configuration
+        has moved by more than DYNAMICS_UPDATE_DQ_THR since their last update (the placement of
+        the floating base does not affect M).
+    '''
+    def isDynamicsUpdateNeeded(self, q):
+        if(self.q_dynamics_update is None or self.DYNAMICS_UPDATE_PERIOD<=1):
+            return True;
+        self.dynamics_staleness_ticks += 1;
+        i0 = 7 if self.freeFlyer else 0;
+        self.dynamics_staleness_dq = norm(q[i0:] - self.q_dynamics_update[i0:]);
+        if(self.dynamics_staleness_ticks>=self.DYNAMICS_UPDATE_PERIOD):
+            return True;
+        if(self.dynamics_staleness_dq>self.DYNAMICS_UPDATE_DQ_THR):
+            return True;
+        return False;
+        
+    ''' Force the recomputation of the slowly varying dynamics quantities at the next call
+        to setNewSensorData.
+    '''
+    def invalidateDynamics(self):
+        self.q_dynamics_update = None;
+        
+    ''' Update the contact Jacobians and the mapping y = C*tau + c.
+        @param refreshFactorization If False the factorizations and the matrix C computed at the
+                                    last refresh are reused and only c is updated
+    '''
+    def updateConstrainedDynamics(self, refreshFactorization=True):
         t = self.t;
         q = self.q;
         v = self.v;
         k = self.k;
         nv = self.nv;
         i = 0;
-        for constr in self.rigidContactConstraints:
-            dim = constr.dim
-            (self.Jc[i:i+dim,:], self.dJc_v[i:i+dim], self.ddx_c_des[i:i+dim]) = constr.dyn_value(t, q, v, local_frame=False);
-            i += dim;
-        for constr in self.bilateralContactConstraints:
+        for constr in self.rigidContactConstraints + self.bilateralContactConstraints:
             dim = constr.dim
             (self.Jc[i:i+dim,:], self.dJc_v[i:i+dim], self.ddx_c_des[i:i+dim]) = constr.dyn_value(t, q, v, local_frame=False);
+            s = self.taskSupport(constr);
+            if(s is None):
+                self.dx_c[i:i+dim] = np.dot(self.Jc[i:i+dim,:], v);
+            else:
+                self.dx_c[i:i+dim] = np.dot(self.Jc[i:i+dim,s], v[s]);
             i += dim;
-        self.Minv        = np.linalg.inv(self.M);
+        
+        if(self.DYNAMICS_FORMULATION=='direct'):
+            return;
+        if(self.DYNAMICS_FORMULATION=='projected'):
+            self.updateConstrainedDynamicsProjected(refreshFactorization);
+        else:
+            self.updateConstrainedDynamicsCholesky(refreshFactorization);
+        self.C[nv+k:,:] = np.matlib.eye(self.na);
+        
+    ''' Compute C and c such that y = C*tau + c, where y = [dv, f, tau], by eliminating
+        dv and f through a triangular factorization M = L^T*L of the mass matrix.
+        The velocity variables are ordered from the root to the leaves of the kinematic tree,
+        so L is zero wherever M is (Featherstone's LTL factorization): L^-T*Jc^T is zero
+        outside the support of the contact Jacobians, and it is computed, together with
+        Jc*M^-1*Jc^T, from the rows and columns of L in that support only.
+    '''
+    def updateConstrainedDynamicsCholesky(self, refreshFactorization=True):
+        k = self.k;
+        nv = self.nv;
+        # Factorize M once and use triangular solves instead of inverting M and Lambda_c.
+        # Without contacts:  dv = M^-1*(S^T*tau - h)
+        # With contacts:     f  = Lambda_c*(Jc*M^-1*(h - S^T*tau) - dJc*v + ddx_c_des)
+        #                    dv = M^-1*(S^T*tau - h + Jc^T*f)
+        # M does not depend on the contacts, so after a contact switch only the contact terms are recomputed.
+        if(refreshFactorization or self.M_ltl is None):
+            if(self.Minv_S_T is None or self.M_ltl is None):
+                # Cholesky factorization of M with the order of the variables reversed
+                self.M_ltl          = np.ascontiguousarray(cholesky(self.M[::-1,::-1], lower=True)[::-1,::-1].T);
+                self.Minv_S_T       = self.solveMassMatrix(self.S_T);
+            L                   = self.M_ltl;
+            self.C[0:nv,:]      = self.Minv_S_T;
+            if(self.k>0):
+                s                   = self.contactSupport();
+                X                   = np.zeros((nv,k));     # L^-T*Jc^T, zero outside s
+                X[s,:]              = solve_triangular(L[np.ix_(s,s)], self.Jc[:,s].T, trans='T', lower=True);
+                self.Jc_Minv        = solve_triangular(L, X, lower=True).T;    # (L^-1*L^-T*Jc^T)^T
+                self.Lambda_c_chol  = (cholesky(np.dot(X[s,:].T, X[s,:]) + 1e-10*np.matlib.eye(self.k), lower=True), True);
+                self.Jc_T_pinv      = cho_solve(self.Lambda_c_chol, self.Jc_Minv);
+                self.C[nv:nv+k,:]   = -np.dot(self.Jc_T_pinv, self.S_T);
+                self.C[0:nv,:]     += np.dot(self.Jc_Minv.T, self.C[nv:nv+k,:]);
+        
+        Minv_h = self.solveMassMatrix(self.h);
         if(self.k>0):
-            self.Jc_Minv     = np.dot(self.Jc, self.Minv);
-            self.Lambda_c    = np.linalg.inv(np.dot(self.Jc_Minv, self.Jc.T) + 1e-10*np.matlib.eye(self.k));
-            self.Jc_T_pinv   = np.dot(self.Lambda_c, self.Jc_Minv);
-            self.Nc_T        = np.matlib.eye(self.nv) - np.dot(self.Jc.T, self.Jc_T_pinv);
-            self.dx_c        = np.dot(self.Jc, self.v);
+            self.c[nv:nv+k]     = cho_solve(self.Lambda_c_chol, np.dot(self.Jc_Minv, self.h) - self.dJc_v + self.ddx_c_des);
+            self.c[0:nv]        = -Minv_h + np.dot(self.Jc_Minv.T, self.c[nv:nv+k]);
         else:
-            self.Nc_T        = np.matlib.eye(self.nv);
-        
-        # Compute C and c such that y = C*tau + c, where y = [dv, f, tau]
-        self.C[0:nv,:]      = np.dot(self.Minv, np.dot(self.Nc_T, self.S_T));
-        self.C[nv:nv+k,:]   = -np.dot(self.Jc_T_pinv, self.S_T);
-        self.C[nv+k:,:]     = np.matlib.eye(self.na);
-        self.c[0:nv]        = - np.dot(self.Minv, (np.dot(self.Nc_T,self.h) + np.dot(self.Jc.T, np.dot(self.Lambda_c, self.dJc_v - self.ddx_c_des))));
-        self.c[nv:nv+k]     = np.dot(self.Lambda_c, (np.dot(self.Jc_Minv, self.h) - self.dJc_v + self.ddx_c_des));
-
+            self.c[0:nv]        = -Minv_h;
+            
+    ''' Return M^-1*X, computed with the factorization M = L^T*L of updateConstrainedDynamicsCholesky. '''
+    def solveMassMatrix(self, X):
+        return solve_triangular(self.M_ltl, solve_triangular(self.M_ltl, X, trans='T', lower=True), lower=True);
+            
+    ''' Compute C and c such that y = C*tau + c, where y = [dv, f, tau], by projecting the
+        dynamics M*dv + h = S^T*tau + Jc^T*f onto the constraint-consistent subspace.
+        With the QR decomposition Jc^T = [Q1 Q2]*[R; 0], the contact constraint
+        Jc*dv = ddx_c_des - dJc*v fixes the Q1 component of dv, while the projected dynamics
+        Q2^T*(M*dv + h - S^T*tau) = 0 fixes its Q2 component and does not depend on f.
+        The contact forces are then recovered as f = R^-1*Q1^T*(M*dv + h - S^T*tau).
+        Only the reduced (nv-k)x(nv-k) matrix Q2^T*M*Q2 is factorized. If Jc is rank
+        deficient the method falls back to the Cholesky-based elimination.
+    '''
+    def updateConstrainedDynamicsProjected(self, refreshFactorization=True):
+        k = self.k;
+        nv = self.nv;
+        if(refreshFactorization or self.M_chol is None):
+            self.Jc_QR = None;
+            if(k>0):
+                (Q, R) = qr(self.Jc.T);
+                R = R[:k,:];
+                if(np.min(np.abs(np.diag(R))) >= self.QR_RANK_THR):
+                    self.Jc_QR = (Q[:,:k], Q[:,k:], R);
+            if(self.Jc_QR is None):
+                return self.updateConstrainedDynamicsCholesky(True);
+            (Q1, Q2, R) = self.Jc_QR;
+            self.M_chol         = (cholesky(np.dot(Q2.T, np.dot(self.M, Q2)), lower=True), True);
+            self.Minv_S_T       = None;
+            self.C[0:nv,:]      = np.dot(Q2, cho_solve(self.M_chol, np.dot(Q2.T, self.S_T)));
+            self.C[nv:nv+k,:]   = solve_triangular(R, np.dot(Q1.T, np.dot(self.M, self.C[0:nv,:]) - self.S_T));
+        elif(self.Jc_QR is None):
+            return self.updateConstrainedDynamicsCholesky(False);
+        
+        # component of dv fixed by the contact constraints: Jc*dv0 = ddx_c_des - dJc*v
+        (Q1, Q2, R) = self.Jc_QR;
+        dv0                 = np.dot(Q1, solve_triangular(R, self.ddx_c_des - self.dJc_v, trans='T'));
+        self.c[0:nv]        = dv0 - np.dot(Q2, cho_solve(self.M_chol, np.dot(Q2.T, self.h + np.dot(self.M, dv0))));
+        self.c[nv:nv+k]     = solve_triangular(R, np.dot(Q1.T, np.dot(self.M, self.c[0:nv]) + self.h));
         
     def computeCostFunction(self, t):
         n_tasks = len(self.tasks);
@@ -470,16 +802,61 @@ class InvDynFormulation (object):
             J[k], drift[k], a_des[k] = self.tasks[k].dyn_value(t, self.q, self.v);
             dims[k] = a_des[k].shape[0];
             dim += dims[k];
-        A = zeros((dim, self.nv+self.k+self.na));
-        a = zeros(dim);
+        # tasks act on dv only, so their rows are written directly in preallocated D and d
+        # and the zero columns of the task Jacobians on f and tau are never multiplied
+        L = self.contactLayout;
+        if(self.DYNAMICS_FORMULATION=='direct'):
+            # add a small regularization on the contact forces
+            D = L.buffer('D', dim+self.k, self.n_qp);
+            d = L.buffer('d', dim+self.k, 1, zero=False);
+            i = 0;
+            for k in range(n_tasks):
+                D[i:i+dims[k],:self.nv] = self.task_weights[k]*J[k];
+                d[i:i+dims[k]]          = self.task_weights[k]*(a_des[k] - drift[k]);
+                i += dims[k];
+            D[dim:,self.nv:] = self.DIRECT_FORCE_REGULARIZATION*np.matlib.eye(self.k);
+            d[dim:] = 0.0;
+            return (D,d);
+        
+        C_dv = self.C[:self.nv,:];
+        c_dv = self.c[:self.nv];
+        D = L.buffer('D', dim, self.na, zero=False);
+        d = L.buffer('d', dim, 1, zero=False);
         i = 0;
         for k in range(n_tasks):
-            A[i:i+dims[k],:self.nv] = self.task_weights[k]*J[k];
-            a[i:i+dims[k]]          = self.task_weights[k]*(a_des[k] - drift[k]);
+            # only the columns in the support of the task Jacobian contribute to J*C and J*c
+            s = self.taskSupport(self.tasks[k]);
+            if(s is None):
+                D[i:i+dims[k],:]    = self.task_weights[k]*np.dot(J[k], C_dv);
+                d[i:i+dims[k]]      = self.task_weights[k]*(a_des[k] - drift[k] - np.dot(J[k], c_dv));
+            else:
+                J_s = J[k][:,s];
+                D[i:i+dims[k],:]    = self.task_weights[k]*np.dot(J_s, C_dv[s,:]);
+                d[i:i+dims[k]]      = self.task_weights[k]*(a_des[k] - drift[k] - np.dot(J_s, c_dv[s]));
             i += dims[k];
-        D       = np.dot(A,self.C);
-        d       = a - np.dot(A,self.c);
         return (D,d);
+        
+    ''' Return the indices of the columns of the Jacobian of the specified task (or constraint)
+        that can be nonzero, or None if they are unknown or cover more than half of the columns.
+    '''
+    def taskSupport(self, task):
+        s = getattr(task, 'support', None);
+        if(s is None or 2*len(s)>self.nv):
+            return None;
+        return s;
+        
+    ''' Return the sorted indices of the columns of the contact Jacobian Jc that can be nonzero,
+        i.e. the union of the supports of the contact constraints (all the columns if the
+        support of one of them is unknown).
+    '''
+    def contactSupport(self):
+        s = np.zeros(0, np.int);
+        for constr in self.rigidContactConstraints + self.bilateralContactConstraints:
+            s_i = getattr(constr, 'support', None);
+            if(s_i is None):
+                return np.arange(self.nv);
+            s = np.union1d(s, s_i);
+        return s;
     
     
     ''' ********** GET ROBOT STATE ********** '''        
@@ -556,19 +933,21 @@ class InvDynFormulation (object):
         return (B,b);
     
     
-    ''' Compute the inequality constraints that ensure the contact forces (expressed in world frame)
-        are inside the (linearized) friction cones.
+    ''' Compute the inequality constraints B*f + b >= 0 that ensure the contact forces are
+        inside the (linearized) friction cones.
         @param fMin Minimum normal force
         @param mu Friction coefficient
         @param contact_points A 3xN matrix containing the contact points expressed in local frame
         @param contact_normals A 3xN matrix containing the contact normals expressed in local frame
-        @param oRi Rotation matrix from local to world frame
+        @param oRi Rotation matrix from local to world frame, used to express the forces of
+                   contacts with several points in world frame; if None (default) they are
+                   expressed in the local frame (see rotateContactForceInequalities)
     '''
-    def createContactForceInequalities(self, fMin, mu, contact_points, contact_normals, oRi):
+    def createContactForceInequalities(self, fMin, mu, contact_points, contact_normals, oRi=None):
         if(contact_points.shape[1]>1):
             B = -1*compute6dContactInequalities(contact_points.T, contact_normals.T, mu[0]);
-            B[:,:3] = np.dot(B[:,:3], oRi.T);
-            B[:,3:] = np.dot(B[:,3:], oRi.T);
+            if(oRi is not None):
+                B = self.rotateContactForceInequalities(B, oRi);
             b = zeros(B.shape[0]);
         elif(norm(contact_points)<EPS):
             B = zeros((5,6));
@@ -586,33 +965,133 @@ class InvDynFormulation (object):
 
         return (B,b);
         
+    ''' Express the 6d force inequalities B of a contact frame in a frame rotated by oRi. '''
+    def rotateContactForceInequalities(self, B, oRi):
+        B_o = np.empty(B.shape);
+        B_o[:,:3] = np.dot(B[:,:3], oRi.T);
+        B_o[:,3:] = np.dot(B[:,3:], oRi.T);
+        return B_o;
+        
         
     ''' Compute the matrix A and the vectors lbA, ubA such that:
             lbA <= A*tau <= ubA
         ensures that all the inequality constraints the system is subject to are satisfied.
         Before calling this method you should call setNewSensorData to set the current state of 
-        the robot.
+        the robot. A and ubA are C-contiguous views on the buffers of contactLayout, which are
+        overwritten at the next call.
     '''
     def createInequalityConstraints(self):
         n = self.na;
+        m_f = self.m_f;     # B and b start at inequality m_f
 
         if(self.ENABLE_JOINT_LIMITS):
             (B_q, b_q) = self.createJointAccInequalitiesViability();
-            self.B[self.ind_acc_in, 6:n+6]      = B_q;
-            self.b[self.ind_acc_in]             = b_q;
+            self.B[np.array(self.ind_acc_in, np.int)-m_f, 6:n+6]  = B_q;
+            self.b[np.array(self.ind_acc_in, np.int)-m_f]         = b_q;
             
         if(self.ENABLE_CAPTURE_POINT_LIMITS):
             (B_cp, b_cp) = self.createCapturePointInequalities();
-            self.B[self.ind_cp_in, :n+6]        = B_cp;
-            self.b[self.ind_cp_in]              = b_cp;
+            self.B[np.array(self.ind_cp_in, np.int)-m_f, :n+6]    = B_cp;
+            self.b[np.array(self.ind_cp_in, np.int)-m_f]          = b_cp;
+        
+        if(self.DYNAMICS_FORMULATION=='direct'):
+            return self.createDirectConstraints();
+        
+        # G = B*C and glb = b + B*c, exploiting the block structure of the inequalities:
+        # the force inequalities are block diagonal on the columns of f,
+        # the joint acceleration limits are +/-identity on the actuated columns of dv
+        # and the capture point inequalities only involve dv.
+        # The row blocks of the C-contiguous G and glb are contiguous, so the products are written in place.
+        C = self.C;
+        c = self.c;
+        if(self.ENABLE_FORCE_LIMITS):
+            L = self.contactLayout;
+            for name in L.names:
+                rows = L.rowSlice(name);
+                cols = L.colSlice(name);
+                Bf_i = L.Bf[rows, cols];
+                cols = slice(self.nv+cols.start, self.nv+cols.stop);
+                np.dot(Bf_i, C[cols,:], out=self.G[rows,:]);
+                np.dot(Bf_i, c[cols], out=self.glb[rows]);
+                self.glb[rows]  += L.bf[rows];
+        
+        if(self.ENABLE_JOINT_LIMITS and n>0):
+            i0 = self.ind_acc_in[0];
+            self.G[i0:i0+n,:]       =  C[6:n+6,:];
+            self.G[i0+n:i0+2*n,:]   = -C[6:n+6,:];
+            self.glb[i0:i0+2*n]     = self.b[i0-m_f:i0-m_f+2*n];
+            self.glb[i0:i0+n]      += c[6:n+6];
+            self.glb[i0+n:i0+2*n]  -= c[6:n+6];
+            
+        if(self.ENABLE_CAPTURE_POINT_LIMITS and len(self.ind_cp_in)>0):
+            i0 = self.ind_cp_in[0];
+            i1 = i0+len(self.ind_cp_in);
+            np.dot(self.B[i0-m_f:i1-m_f, :n+6], C[:n+6,:], out=self.G[i0:i1,:]);
+            np.dot(self.B[i0-m_f:i1-m_f, :n+6], c[:n+6], out=self.glb[i0:i1]);
+            self.glb[i0:i1]    += self.b[i0-m_f:i1-m_f];
         
-        self.G       = np.dot(self.B, self.C);
-        self.glb     = self.b + np.dot(self.B, self.c);
-        self.gub     = 1e10*np.matlib.ones((self.m_in,1))
         return (self.G, -self.glb, self.gub, self.lb, self.ub);
+        
+    ''' Compute the matrix A_x and the vectors lbA, ubA, lb, ub such that:
+            lbA <= A_x*x <= ubA
+             lb <= x <= ub
+        where x = [dv, f]. The dynamics M*dv + h = S^T*tau + Jc^T*f and the contact constraints
+        Jc*dv + dJc*v = ddx_c_des are imposed as equalities, while the torque limits become
+        linear inequalities on the actuated rows of the dynamics. Called by
+        createInequalityConstraints when DYNAMICS_FORMULATION is 'direct'.
+    '''
+    def createDirectConstraints(self):
+        nv = self.nv;
+        nu = nv-self.na;    # number of unactuated DoFs
+        m_in = self.m_in;
+        m_f = self.m_f;
+        
+        # contact force inequalities, block diagonal on the columns of f
+        if(m_f>0):
+            L = self.contactLayout;
+            for name in L.names:
+                rows = L.rowSlice(name);
+                cols = L.colSlice(name);
+                self.A_x[rows, nv+cols.start:nv+cols.stop] = L.Bf[rows, cols];
+            self.lbA_x[:m_f]    = -L.bf;
+        self.A_x[m_f:m_in,:nv]  = self.B;
+        self.lbA_x[m_f:m_in]    = -self.b;
+        self.ubA_x[:m_in]       = 1e10;
+        
+        # dynamics: M*dv - Jc^T*f = S^T*tau - h
+        i = m_in;
+        self.A_x[i:i+nv,:nv]    = self.M;
+        self.A_x[i:i+nv,nv:]    = -self.Jc.T;
+        self.lbA_x[i:i+nu]      = -self.h[:nu];
+        self.ubA_x[i:i+nu]      = -self.h[:nu];
+        self.lbA_x[i+nu:i+nv]   = self.lb - self.h[nu:];
+        self.ubA_x[i+nu:i+nv]   = self.ub - self.h[nu:];
+        
+        # contact constraints: Jc*dv = ddx_c_des - dJc*v
+        i += nv;
+        self.A_x[i:,:nv]    = self.Jc;
+        self.lbA_x[i:]      = self.ddx_c_des - self.dJc_v;
+        self.ubA_x[i:]      = self.lbA_x[i:];
+        
+        lb = zeros(self.n_qp) - 1e100;
+        ub = zeros(self.n_qp) + 1e100;
+        return (self.A_x, self.lbA_x, self.ubA_x, lb, ub);
+        
+    ''' Split the solution x = [dv, f] of the direct formulation and compute the
+        corresponding joint torques tau = (M*dv + h - Jc^T*f)[actuated DoFs].
+    '''
+    def splitDirectSolution(self, x):
+        nv = self.nv;
+        x = np.asmatrix(x).reshape((self.n_qp,1));
+        dv = x[:nv];
+        f = x[nv:];
+        tau = (np.dot(self.M, dv) + self.h - np.dot(self.Jc.T, f))[nv-self.na:];
+        return (dv, f, tau);
     
         
     def createForceRegularizationTask(self, w_f):
+        if(self.DYNAMICS_FORMULATION=='direct'):
+            raise ValueError("[InvDynForm] ERROR: the force regularization task needs C and c, which the 'direct' formulation does not compute (it regularizes the forces in computeCostFunction)");
         n = self.n;      # number of joints
         k = self.k;
         A = zeros((12,2*n+6+k));
@@ -620,3 +1099,60 @@ class InvDynFormulation (object):
         D       = np.dot(A,self.C);
         d       = - np.dot(A,self.c);
         return (D,d);
+        
+        
+    ''' ********** CONTROL LOOP ********** '''
+    
+    ''' Run one control tick: update the robot state, compute the cost function and the
+        constraints, and solve the resulting QP warm-started with the previous solution.
+        The wall time of each stage (see STEP_TIMING_STAGES) is stored in a ring buffer
+        that can be read with getStepTimings.
+        @return (tau, dv, f) The joint torques, accelerations and contact forces
+    '''
+    def step(self, t, q, v, maxIter=None, maxTime=100.0):
+        times = self.step_times[self.step_index % self.STEP_TIMING_BUFFER_SIZE];
+        start = time.time();
+        self.setNewSensorData(t, q, v);
+        times[0] = time.time();
+        (D, d) = self.computeCostFunction(t);
+        times[1] = time.time();
+        (A, lbA, ubA, lb, ub) = self.createInequalityConstraints();
+        times[2] = time.time();
+        
+        if(self.solver is None or self.solver.n!=self.n_qp):
+            self.solver = StandardQpSolver(self.n_qp, self.m_qp, self.STEP_SOLVER, verb=self.verb);
+            self.x_prev = None;
+        else:
+            self.solver.changeInequalityNumber(self.m_qp);
+        # the solver works on arrays: 2d matrices and 1d vectors
+        x0 = None if self.x_prev is None else np.asmatrix(self.x_prev).A1;
+        (x, imode) = self.solver.solve(np.asarray(D), np.asarray(d).ravel(), np.asarray(A), lbA.A1, ubA.A1, lb.A1, ub.A1,
+                                       x0=x0, maxIter=maxIter, maxTime=maxTime);
+        self.x_prev = np.array(x).squeeze();
+        times[3] = time.time();
+        
+        if(self.DYNAMICS_FORMULATION=='direct'):
+            (self.dv, self.f, self.tau) = self.splitDirectSolution(x);
+        else:
+            self.tau = np.asmatrix(x).reshape((self.na,1));
+            y = np.dot(self.C, self.tau) + self.c;
+            self.dv = y[:self.nv];
+            self.f = y[self.nv:self.nv+self.k];
+        times[4] = time.time();
+        
+        times[1:] -= times[:-1].copy();
+        times[0] -= start;
+        times[-1] = np.sum(times[:-1]);
+        self.step_index += 1;
+        return (self.tau, self.dv, self.f);
+    
+    ''' Return a NxS array with the wall times (in seconds) of the last N calls to step
+        (at most STEP_TIMING_BUFFER_SIZE), ordered from the oldest to the most recent,
+        for the S stages listed in STEP_TIMING_STAGES.
+    '''
+    def getStepTimings(self):
+        N = self.STEP_TIMING_BUFFER_SIZE;
+        if(self.step_index<N):
+            return np.copy(self.step_times[:self.step_index]);
+        i = self.step_index % N;
+        return np.vstack((self.step_times[i:], self.step_times[:i]));
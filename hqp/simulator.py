@@ -127,9 +127,8 @@ class Simulator(object):
         self.name = name
         self.robot = robot
         self.reset(0, robot.q, robot.v, robot.dt, robot.nv)
-        self.viewer = Viewer(self.robot.name, self.robot)
+        self.viewer_instance = None  # created on first use, see viewer
         self.updateRobotConfig(self.robot.q0)
-        self.viewer.display(self.robot.q0,robot.name)
         #self.fMin = 0.001 
         #self.mu = np.array([ 0.3,  0.1])
         #self.nq = self.robot.nq
@@ -139,6 +138,15 @@ class Simulator(object):
         #if(self.DISPLAYCOM):
         #    self.viewer.addSphere('com', self.COM_SPHERE_RADIUS, mat_zeros(3), mat_zeros(3), self.COM_SPHERE_COLOR, 'OFF')
     
+    @property
+    def viewer(self):
+        ''' The viewer is connected only when something has to be displayed,
+        so that simulations can run on machines without the GUI stack '''
+        if self.viewer_instance is None:
+            self.viewer_instance = Viewer(self.robot.name, self.robot)
+            self.viewer_instance.display(self.robot.q, self.robot.name)
+        return self.viewer_instance
+
     def updateRobotConfig(self, q): 
         se3.computeAllTerms(self.robot.model,
                             self.robot.data,
@@ -61,6 +61,8 @@ class SE3Task(Task):
         # for local to global
         self._gMl = SE3.Identity()
         self.__gain_matrix = np.matrix(np.eye(robot.nv))
+        # frame Jacobian, written by robot.frameJacobian at every evaluation
+        self._J = np.matrix(np.zeros((6, robot.nv)))
 
     def mask(self, mask):
         assert len(mask) == 6, "The mask must have 6 elemets"
@@ -85,6 +87,11 @@ class SE3Task(Task):
     def framePosition(self):
         return self.robot.framePosition(self._frame_id)
 
+    @property
+    def support(self):
+        ''' Columns of the task Jacobian that can be nonzero '''
+        return self.robot.frameSupport(self._frame_id)
+
     def positionError(self, t):
         oMi = self.robot.framePosition(self._frame_id)
         M_ref, v_ref, a_ref = self._ref_trajectory(t)
@@ -120,13 +127,11 @@ class SE3Task(Task):
         if self.adaptGain is True:
             self.kp = adaptativeGain(p_error.vector, self.kmin, self.kmax, self.beta)
         v_des = - self.kp * p_error.vector  - self.kv * v_error.vector
-        J= self.robot.frameJacobian(q, self._frame_id, False)
+        J= self.robot.frameJacobian(q, self._frame_id, False, local_frame, out=self._J)
 
         if(local_frame==False):
             v_des[:3] = self._gMl.rotation * v_des[:3];
             v_des[3:] = self._gMl.rotation * v_des[3:];
-            J[:3,:] = self._gMl.rotation * J[:3,:];
-            J[3:,:] = self._gMl.rotation * J[3:,:];
         return J[self._mask,:], v_des[self._mask]
 
 
@@ -154,14 +159,12 @@ class SE3Task(Task):
         #if self.adaptGain is True:
         #    self.kp = adaptativeGain(p_error.vector, self.kmin, self.kmax, self.beta)
         a_des = self._gMl.actInv(a_ref).vector - (self.kp*self.p_error.vector + self.kv*self.v_error.vector) 
-        J = self.robot.frameJacobian(q, self._frame_id, False)
+        J = self.robot.frameJacobian(q, self._frame_id, False, local_frame, out=self._J)
         
         if(local_frame==False):
             drift = self._gMl.act(drift);
             a_des[:3] = self._gMl.rotation * a_des[:3];
             a_des[3:] = self._gMl.rotation * a_des[3:];
-            J[:3,:] = self._gMl.rotation * J[:3,:];
-            J[3:,:] = self._gMl.rotation * J[3:,:];
 
         return J[self._mask,:]*self.__gain_matrix, drift.vector[self._mask], a_des[self._mask]
 
@@ -400,7 +403,9 @@ class MomentumTask(Task):
 
         m_gravity = model.gravity.copy()
         model.gravity.setZero()
-        b = se3.nle(model,data,q,v)
+        # on a Data object of the pool, so that robot.data and the quantities cached for q, v stay valid
+        with self.robot.dataContext() as nle_data:
+            b = se3.nle(model,nle_data,q,v).copy()
         model.gravity = m_gravity
         f_ff = se3.Force(b[:6])
         f_com = cXi.act(f_ff)
@@ -448,9 +453,9 @@ class MomentumTask(Task):
 
     def dyn_value_h(self, t, q, v):
         (self.hg_ref, self.dhg_ref, aahg_ref) = self._ref_traj(t)
-        JMom = se3.ccrba(self.robot.model, self.robot.data, q, v)
+        JMom = self.robot.ccrba(q, v)
         b = self._getBiais(q,v)
-        self.hg_act =  self.robot.data.hg.np.A.copy()
+        self.hg_act =  self.robot.centroidalMomentum(q, v).np.A.copy()
         self.dhg_act = self._calculateHdot(q)
         
         self.drift=b[self._mask,:]
@@ -465,9 +470,9 @@ class MomentumTask(Task):
 
     def dyn_value(self, t, q, v):
         (self.hg_ref, self.dhg_ref, aahg_ref) = self._ref_traj(t)
-        JMom = se3.ccrba(self.robot.model, self.robot.data, q, v)
+        JMom = self.robot.ccrba(q, v)
         b = self._getBiais(q,v)
-        self.hg_act =  self.robot.data.hg.np.A.copy()
+        self.hg_act =  self.robot.centroidalMomentum(q, v).np.A.copy()
         self.dhg_act = self._calculateHdot(q)
         
         self.drift=b[self._mask,:]
@@ -513,9 +518,8 @@ class FlyMomentumTask(Task):
         #(hg_ref, vhg_ref, ahg_ref) = self._ref_traj(t)
         vhg_ref = np.matrix([0., 0., 0., 0., 0., 0.]).T
         model =   self.robot.model
-        data =    self.robot.data 
-        JMom =    se3.ccrba(model, data, q, v)
-        hg_prv = data.hg.vector.copy()[self._mask,:]
+        JMom =    self.robot.ccrba(q, v)
+        hg_prv = self.robot.centroidalMomentum(q, v).vector.copy()[self._mask,:]
         #self.p_error = data.hg.vector.copy()[self._mask,:] - vhg_ref[self._mask,:]
         #self.v_error = self.robot.fext[self._mask,:] - vhg_ref[self._mask,:]
         #self.v_error = self.robot.fext[self._mask,:] 
@@ -526,14 +530,16 @@ class FlyMomentumTask(Task):
         #self.drift = 0 * self.a_des
         #self.a_des   = 
         #***********************
-        p_com = data.com[0]
+        p_com = self.robot.com(q)
         cXi = SE3.Identity()
         oXi = self.robot.data.oMi[1]
         cXi.rotation = oXi.rotation
         cXi.translation = oXi.translation - p_com
         m_gravity = model.gravity.copy()
         model.gravity.setZero()
-        b = se3.nle(model,data,q,v)
+        # on a Data object of the pool, so that robot.data and the quantities cached for q, v stay valid
+        with self.robot.dataContext() as nle_data:
+            b = se3.nle(model,nle_data,q,v).copy()
         model.gravity = m_gravity
         f_ff = se3.Force(b[:6])
         f_com = cXi.act(f_ff)
@@ -1,5 +1,6 @@
 import numpy as np
 import numpy.matlib
+from scipy.linalg import solve_banded
 from pinocchio import SE3, log3, exp3, Motion
 from derivative_filters import computeSecondOrderPolynomialFitting
 
@@ -125,6 +126,114 @@ class SmoothedNdTrajectory (object):
 
 
 
+''' An Nd trajectory interpolating a discrete-time trajectory with a piecewise cubic
+    polynomial. The coefficients of every segment are computed once in the constructor,
+    so that the evaluation at any time costs O(1). The trajectory can be evaluated
+    at a single time, returning Nx1 matrices, or at an array of K times, returning
+    NxK matrices. Like VaryingNdTrajectory it accepts any time t < T*dt: over the
+    last time step, after the last sample, the last cubic segment is extrapolated.
+    Derived classes define the velocities at the samples (and hence the coefficients).
+'''
+class PiecewiseCubicNdTrajectory (object):
+
+  ''' Constructor.
+      @param x_ref A NxT numpy matrix, where N is the size of the signal and T is the number of time steps
+      @param dt The time step duration in seconds
+      @param v_ref A NxT numpy matrix with the velocities at the samples
+  '''
+  def __init__ (self, name, x_ref, dt, v_ref):
+    self._name = name
+    self._dim = x_ref.shape[0]
+    self._dt = dt
+    x = np.asarray(x_ref, np.float)
+    m = np.asarray(v_ref, np.float)
+    assert x.shape[1]>=2, "The trajectory must contain at least two samples"
+    # x(t_i + s) = c0 + c1*s + c2*s^2 + c3*s^3 for s in [0, dt] (Hermite segments)
+    dx = (x[:,1:] - x[:,:-1])/dt
+    self._c0 = x[:,:-1]
+    self._c1 = m[:,:-1]
+    self._c2 = (3*dx - 2*m[:,:-1] - m[:,1:])/dt
+    self._c3 = (m[:,:-1] + m[:,1:] - 2*dx)/(dt*dt)
+    self._duration = (x.shape[1]-1)*dt   # time of the last sample
+    self._T = x.shape[1]
+
+  @property
+  def dim(self):
+    return self._dim
+
+  @property
+  def duration(self):
+    return self._duration
+
+  def __call__ (self, t):
+    t = np.asarray(t, np.float)
+    assert np.all(t>=0.0), "Time must be non-negative"
+    if(np.any((t/self._dt).astype(np.int)>=self._T)):
+      raise ValueError("Specified time exceeds the duration of the trajectory: "+str(np.max(t)))
+    i = np.minimum((t/self._dt).astype(np.int), self._c0.shape[1]-1)
+    s = t - i*self._dt
+    c0, c1, c2, c3 = self._c0[:,i], self._c1[:,i], self._c2[:,i], self._c3[:,i]
+    x = c0 + s*(c1 + s*(c2 + s*c3))
+    v = c1 + s*(2*c2 + 3*s*c3)
+    a = 2*c2 + 6*s*c3
+    if(t.ndim==0):
+      return (np.matrix(x).T, np.matrix(v).T, np.matrix(a).T)
+    return (np.matrix(x), np.matrix(v), np.matrix(a))
+
+
+''' An Nd trajectory interpolating a discrete-time trajectory with cubic Hermite
+    segments. If the velocities at the samples are not specified they are
+    estimated by finite differences (Catmull-Rom spline), so the interpolation is
+    C1 and only depends on the neighbouring samples.
+'''
+class HermiteNdTrajectory (PiecewiseCubicNdTrajectory):
+
+  ''' Constructor.
+      @param x_ref A NxT numpy matrix, where N is the size of the signal and T is the number of time steps
+      @param dt The time step duration in seconds
+      @param v_ref An optional NxT numpy matrix with the velocities at the samples
+  '''
+  def __init__ (self, name, x_ref, dt, v_ref=None):
+    if(v_ref is None):
+      x = np.asarray(x_ref, np.float)
+      v_ref = np.empty(x.shape)
+      v_ref[:,0] = (x[:,1]-x[:,0])/dt
+      v_ref[:,-1] = (x[:,-1]-x[:,-2])/dt
+      v_ref[:,1:-1] = (x[:,2:]-x[:,:-2])/(2*dt)
+    PiecewiseCubicNdTrajectory.__init__(self, name, x_ref, dt, v_ref)
+
+
+''' An Nd trajectory interpolating a discrete-time trajectory with a natural cubic
+    spline, i.e. with continuous velocity and acceleration and zero acceleration
+    at both ends.
+'''
+class CubicSplineNdTrajectory (PiecewiseCubicNdTrajectory):
+
+  ''' Constructor.
+      @param x_ref A NxT numpy matrix, where N is the size of the signal and T is the number of time steps
+      @param dt The time step duration in seconds
+  '''
+  def __init__ (self, name, x_ref, dt):
+    x = np.asarray(x_ref, np.float)
+    T = x.shape[1]
+    if(T<3):
+      v_ref = np.tile((x[:,-1:]-x[:,:1])/dt, (1, T))
+    else:
+      # velocities of the natural spline: tridiagonal system on the samples
+      # (uniform spacing), solved once for all the dimensions
+      A = np.zeros((3, T))
+      A[0,1:] = 1.
+      A[1,:] = 4.
+      A[1,0] = A[1,-1] = 2.
+      A[2,:-1] = 1.
+      b = np.empty((T, x.shape[0]))
+      b[0] = 3*(x[:,1]-x[:,0])/dt
+      b[-1] = 3*(x[:,-1]-x[:,-2])/dt
+      b[1:-1] = 3*(x[:,2:]-x[:,:-2]).T/dt
+      v_ref = solve_banded((1,1), A, b).T
+    PiecewiseCubicNdTrajectory.__init__(self, name, x_ref, dt, v_ref)
+
+
 ''' An SE3 trajectory computed from a specified discrete-time trajectory
     by applying a polynomial fitting. 
 ''' 
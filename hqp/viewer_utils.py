@@ -1,4 +1,3 @@
-import gepetto.corbaserver
 from first_order_low_pass_filter import FirstOrderLowPassFilter
 from hqp.wrapper import Wrapper as RobotWrapper
 from pinocchio.utils import zero as mat_zeros
@@ -44,6 +43,7 @@ class Viewer(object):
 
     def initDisplay(self, viewerRootNodeName="world/pinocchio"):
         try:
+            import gepetto.corbaserver  # optional, only needed to display
             self.viewer=gepetto.corbaserver.Client()
             print "Connected to corba server"
             self.viewerRootNodeName = viewerRootNodeName
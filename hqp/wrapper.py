@@ -1,27 +1,83 @@
 import pinocchio as se3
 import numpy as np
+import numpy.matlib
 import time
 import os
-from models import osim_parser
-from ospi import model_parser 
-from pinocchio.utils import XYZQUATToViewerConfiguration, zero, se3ToXYZQUAT
-from bmtools.algebra import quaternion_from_matrix, euler_matrix
-from bmtools.filters import *
+import hashlib
+import pickle
+import tempfile
+import multiprocessing
+import threading
+from contextlib import contextmanager
+from pinocchio.utils import zero, se3ToXYZQUAT, rotate
+# models, ospi, bmtools and the filter bank (scipy.signal) are imported where they are
+# used, so that importing the wrapper stays fast and works without these packages
+
+# (robot, arrays, args) inherited by the processes forked by Wrapper.mapTrajectory
+trajectory_worker = None
+
+def runTrajectoryChunk(task):
+    ''' Run robot.<method> on the rows i:j of the arrays set by Wrapper.mapTrajectory
+    (executed in a worker process, with its own copy of the model and data)
+    '''
+    method, i, j = task
+    robot, arrays, args = trajectory_worker
+    return getattr(robot, method)(*([a[i:j] for a in arrays] + list(args)))
 
 class Wrapper():
-    def __init__(self, model_path=None, mesh_path=None, name='Robot',OsimModel=True):
+    # quantities managed by the update planner, with the quantities they need
+    # to be computed first for the same state
+    UPDATE_DEPENDENCIES = {'kinematics': (),
+                           'frames': ('kinematics',),
+                           'jacobians': (),
+                           'M': (),
+                           'nle': (),
+                           'com': (),
+                           'Jcom': (),
+                           'ccrba': ()}
+
+    # index maps from GX OpenSim coordinates to Pinocchio configurations (see dof2pinocchio)
+    # spherical joints: (first index in q, indices of the 'rxyz' Euler angles in dof, signs)
+    OSIM_QUATERNIONS = ((3, (0, 1, 2), (1, 1, 1)),        # pelvis
+                        (7, (6, 7, 8), (1, 1, 1)),        # rhip
+                        (15, (13, 14, 15), (1, -1, -1)),  # lhip
+                        (23, (20, 21, 22), (1, 1, 1)),    # back
+                        (27, (23, 24, 25), (1, 1, 1)),    # neck
+                        (31, (26, 27, 28), (1, 1, 1)),    # rshoulder
+                        (40, (34, 35, 36), (1, -1, -1)))  # lshoulder
+    # revolute joints: (first index in q, first index in dof, number of coordinates)
+    OSIM_COPIES = ((11, 9, 4), (19, 16, 4), (35, 29, 5), (44, 37, 5))
+
+    # Lie group of the configuration of each joint type (see lieGroupSegments)
+    LIE_GROUPS = {'JointModelFreeFlyer': 'freeflyer',
+                  'JointModelSpherical': 'spherical',
+                  'JointModelRX': 'euclidean',
+                  'JointModelRY': 'euclidean',
+                  'JointModelRZ': 'euclidean',
+                  'JointModelRevoluteUnaligned': 'euclidean',
+                  'JointModelPX': 'euclidean',
+                  'JointModelPY': 'euclidean',
+                  'JointModelPZ': 'euclidean',
+                  'JointModelPrismaticUnaligned': 'euclidean',
+                  'JointModelTranslation': 'euclidean'}
+    # joints whose axis is an argument of the constructor (see modelTables)
+    UNALIGNED_JOINTS = {'JointModelRevoluteUnaligned': 3,  # rows of the axis in the local Jacobian
+                        'JointModelPrismaticUnaligned': 0}
+
+    # directory of the parsed models (see loadModel)
+    MODEL_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'hqp', 'models')
+
+    def __init__(self, model_path=None, mesh_path=None, name='Robot',OsimModel=True, cache=True):
         self.name = name
         if model_path is None:
             model_path = '/local/gmaldona/devel/biomechatronics/models/GX.osim'
-        r = model_parser.parseModel()
         self.mesh_path = mesh_path
         self.model_path = model_path
-        r.parseModel(self.model_path,self.mesh_path)
-        self.upperPositionLimitOsim = r.upperPositionLimit
-        self.upperPositionLimitOsim = r.upperPositionLimit
-        self.model = r.model 
-        self.visuals = r.visuals
-        self.data = r.data
+        self.model, self.visuals, self.upperPositionLimitOsim = self.loadModel(cache)
+        self.data = self.model.createData()
+        self.data_pool = []                         # free Data objects, see acquireData
+        self.data_pool_lock = threading.Lock()
+        self.thread_data = threading.local()        # Data of each thread, see threadData
         self.v0 = zero(self.model.nv)
         self.q0 = zero(self.model.nq)
         self.q = self.q0
@@ -31,6 +87,147 @@ class Wrapper():
         self.v = zero(self.model.nv)
         self.a = zero(self.model.nv)
         self.fext = self.data.hg.vector.copy()
+        self.joint_supports = self.computeJointSupports()
+        self.lie_groups = None  # see lieGroupSegments
+        self.filter_bank = None
+        self.state_version = 0  # incremented every time q or v changes
+        self.state_q = None     # state of the update planner, written only by setState
+        self.state_v = None     # (self.q and self.v may be assigned directly by other methods)
+        self.computed = {}      # quantity -> state version it was computed for
+        self.cache = {}         # quantity -> value computed for self.computed[quantity]
+
+    def modelCacheKey(self):
+        ''' Hash of the content of the model file, of the mesh path and of the
+        names, sizes and mtimes of the files in the mesh directory
+        '''
+        sha = hashlib.sha1()
+        sha.update(self.fileHash(self.model_path))
+        sha.update(str(self.mesh_path))
+        if self.mesh_path is not None and os.path.isdir(self.mesh_path):
+            for root, dirs, files in sorted(os.walk(self.mesh_path)):
+                for f in sorted(files):
+                    st = os.stat(os.path.join(root, f))
+                    sha.update('%s:%d:%f' % (os.path.join(root, f), st.st_size, st.st_mtime))
+        return sha.hexdigest()
+
+    def loadModel(self, cache=True):
+        ''' model, visuals, upperPositionLimitOsim = loadModel(cache)
+        Parse the .osim model, or rebuild it from the tables stored in MODEL_CACHE_DIR
+        (see modelTables) if the model file and the meshes did not change since they
+        were stored. The tables are only stored if the model rebuilt from them matches
+        the parsed one, so models with joints that cannot be rebuilt are always parsed.
+        '''
+        use_cache = cache and os.path.isfile(self.model_path)
+        if use_cache:
+            cache_file = os.path.join(self.MODEL_CACHE_DIR, self.modelCacheKey() + '.pkl')
+            if os.path.isfile(cache_file):
+                try:
+                    with open(cache_file, 'rb') as f:
+                        tables = pickle.load(f)
+                    return self.buildModel(tables), tables['visuals'], tables['upperPositionLimitOsim']
+                except (IOError, OSError, EOFError, KeyError, ValueError, pickle.UnpicklingError):
+                    pass
+        from ospi import model_parser
+        r = model_parser.parseModel()
+        r.parseModel(self.model_path, self.mesh_path)
+        if use_cache:
+            tables = self.modelTables(r.model, r.data)
+            if tables is not None:
+                tables['visuals'] = r.visuals
+                tables['upperPositionLimitOsim'] = r.upperPositionLimit
+                try:
+                    if not os.path.isdir(self.MODEL_CACHE_DIR):
+                        os.makedirs(self.MODEL_CACHE_DIR)
+                    self.replaceFile(cache_file, lambda f: pickle.dump(tables, f, pickle.HIGHEST_PROTOCOL))
+                except (IOError, OSError, RuntimeError, pickle.PicklingError) as e:
+                    print 'could not write the model cache: %s' % e
+        return r.model, r.visuals, r.upperPositionLimit
+
+    def modelTables(self, model, data):
+        ''' Joint, body and frame tables of a model, made of numbers, strings and arrays
+        only, from which buildModel creates the same model. The axes of the unaligned
+        joints are read in their local Jacobians. Return None if the model has joints
+        that buildModel does not support, or if the rebuilt model differs from model.
+        '''
+        q = zero(model.nq)
+        joints = []
+        for i in range(1, len(model.joints)):
+            joint = model.joints[i]
+            kind = joint.shortname()
+            if kind not in self.LIE_GROUPS:
+                return None
+            if kind == 'JointModelFreeFlyer':
+                q[joint.idx_q+6] = 1.
+            elif kind == 'JointModelSpherical':
+                q[joint.idx_q+3] = 1.
+            M = model.jointPlacements[i]
+            joints.append([model.parents[i], kind, None, model.names[i],
+                           np.array(M.rotation), np.array(M.translation)])
+        for i, joint in enumerate(joints):
+            if joint[1] in self.UNALIGNED_JOINTS:
+                J = se3.jacobian(model, data, q, i+1, True, True)
+                row = self.UNALIGNED_JOINTS[joint[1]]
+                joint[2] = tuple(np.asarray(J[row:row+3, model.joints[i+1].idx_v]).ravel())
+        tables = {'joints': joints,
+                  'inertias': [(Y.mass, np.array(Y.lever), np.array(Y.inertia)) for Y in model.inertias],
+                  'frames': [(f.name, f.parent, np.array(f.placement.rotation), np.array(f.placement.translation),
+                              int(f.type)) for f in model.frames],
+                  'limits': dict((name, np.array(getattr(model, name))) for name in
+                                 ('effortLimit', 'velocityLimit', 'lowerPositionLimit', 'upperPositionLimit'))}
+        rebuilt = self.buildModel(tables)
+        if (rebuilt.nq != model.nq or rebuilt.nv != model.nv or list(rebuilt.names) != list(model.names)
+                or [f.name for f in rebuilt.frames] != [f.name for f in model.frames]):
+            return None
+        return tables
+
+    def buildModel(self, tables):
+        ''' Create the model described by tables (see modelTables) '''
+        model = se3.Model.BuildEmptyModel()
+        for parent, kind, axis, name, R, p in tables['joints']:
+            joint = getattr(se3, kind)() if axis is None else getattr(se3, kind)(*axis)
+            i = model.addJoint(parent, joint, se3.SE3(np.matrix(R), np.matrix(p)), name)
+            mass, lever, inertia = tables['inertias'][i]
+            model.appendBodyToJoint(i, se3.Inertia(mass, np.matrix(lever), np.matrix(inertia)), se3.SE3.Identity())
+        for name, parent, R, p, kind in tables['frames'][len(model.frames):]:
+            model.addFrame(se3.Frame(name, parent, se3.SE3(np.matrix(R), np.matrix(p)), se3.FrameType.values[kind]))
+        for name, value in tables['limits'].items():
+            setattr(model, name, np.matrix(value))
+        return model
+
+    def acquireData(self):
+        ''' Take a Data object of the model from the pool (creating it if the pool
+        is empty), for the exclusive use of the caller until releaseData
+        '''
+        with self.data_pool_lock:
+            if self.data_pool:
+                return self.data_pool.pop()
+        return self.model.createData()
+
+    def releaseData(self, data):
+        with self.data_pool_lock:
+            self.data_pool.append(data)
+
+    @contextmanager
+    def dataContext(self):
+        ''' with robot.dataContext() as data:
+                robot.framePosition(index, q, data=data)
+        Use a Data object from the pool within the block. The methods that take a
+        data argument then work on it instead of self.data, so that several
+        threads can evaluate the model concurrently.
+        '''
+        data = self.acquireData()
+        try:
+            yield data
+        finally:
+            self.releaseData(data)
+
+    def threadData(self):
+        ''' Data object owned by the calling thread (taken from the pool on first use) '''
+        data = getattr(self.thread_data, 'data', None)
+        if data is None:
+            data = self.acquireData()
+            self.thread_data.data = data
+        return data
 
     @property
     def nq(self):
@@ -70,37 +267,155 @@ class Wrapper():
                 break
         return subtree
 
+    def computeJointSupports(self):
+        ''' For every joint, the indices of the velocity variables of the joint
+        and of all its ancestors, i.e. the only columns where its Jacobian
+        (and the Jacobian of any frame attached to it) can be nonzero
+        '''
+        supports = [np.zeros(0, np.int)]
+        for i in range(1, len(self.model.joints)):
+            joint = self.model.joints[i]
+            own = np.arange(joint.idx_v, joint.idx_v+joint.nv)
+            supports.append(np.union1d(supports[self.model.parents[i]], own))
+        return supports
+
+    def jointSupport(self, index):
+        return self.joint_supports[index]
+
+    def frameSupport(self, index):
+        return self.joint_supports[self.model.frames[index].parent]
+
+    def setState(self, q, v=None):
+        ''' Set the state (q, v) used by the update planner (v defaults to self.v),
+        and copy it into self.q and self.v.
+        The cached quantities remain valid if neither q nor v changed since the
+        last call, whatever was assigned to self.q and self.v in between.
+        '''
+        if v is None:
+            v = self.v
+        self.q = q.copy()
+        self.v = v.copy()
+        if (self.state_q is not None and np.array_equal(q, self.state_q)
+                and np.array_equal(v, self.state_v)):
+            return
+        self.state_q = q.copy()
+        self.state_v = v.copy()
+        self.state_version += 1
+        self.computed.clear()
+
+    def invalidate(self):
+        ''' Mark all the cached quantities as outdated, e.g. after running
+        pinocchio algorithms on self.data with a state other than (q, v)
+        '''
+        self.computed.clear()
+
+    def require(self, *quantities):
+        ''' Make sure that the specified quantities (see UPDATE_DEPENDENCIES)
+        are computed for the current state. Each pinocchio algorithm runs at most
+        once per state version, together with the algorithms it depends on.
+        '''
+        for name in quantities:
+            if self.computed.get(name, -1) == self.state_version:
+                continue
+            for dependency in self.UPDATE_DEPENDENCIES[name]:
+                self.require(dependency)
+            self.cache[name] = self.computeQuantity(name)
+            self.computed[name] = self.state_version
+
+    def computeQuantity(self, name):
+        q, v = self.state_q, self.state_v
+        if name == 'kinematics':
+            se3.forwardKinematics(self.model, self.data, q, v, self.a)
+        elif name == 'frames':
+            se3.framesKinematics(self.model, self.data, q)
+        elif name == 'jacobians':
+            # the joint placements are stored with the joint Jacobians, so that frameJacobian
+            # does not depend on what other methods write in self.data in the meantime
+            se3.computeJacobians(self.model, self.data, q)
+            return self.data.J.copy(), [se3.SE3(M.rotation, M.translation) for M in self.data.oMi]
+        elif name == 'M':
+            return se3.crba(self.model, self.data, q).copy()
+        elif name == 'nle':
+            return se3.nle(self.model, self.data, q, v).copy()
+        elif name == 'com':
+            se3.centerOfMass(self.model, self.data, q, v, self.a)
+            return self.data.com[0].copy(), self.data.vcom[0].copy(), self.data.acom[0].copy()
+        elif name == 'Jcom':
+            return se3.jacobianCenterOfMass(self.model, self.data, q).copy()
+        elif name == 'ccrba':
+            Ag = se3.ccrba(self.model, self.data, q, v).copy()
+            return Ag, se3.Force(self.data.hg.vector.copy())
+        else:
+            raise ValueError('Unknown quantity: %s' % name)
+        return None
+
     def update(self,q):
-        se3.computeAllTerms(self.model, self.data, self.q, self.v)
-        #se3.forwardKinematics(self.model, self.data, q, self.v, self.a)
-        #- se3::forwardKinematics 
-        #- se3::crba
-        #- se3::nonLinearEffects
-        #- se3::computeJacobians 
-        #- se3::centerOfMass                                                                                  
-        #- se3::jacobianCenterOfMass
-        #- se3::kineticEnergy   
-        #- se3::potentialEnergy   
-        se3.framesKinematics(self.model, self.data, q)
-        se3.computeJacobians(self.model, self.data, q)
-        se3.rnea(self.model, self.data, q, self.v, self.a)
-        self.biais(self.q, self.v)
-        self.q = q.copy()        
+        self.setState(q)
+        self.require('kinematics', 'jacobians', 'frames', 'M', 'nle', 'com', 'Jcom')
 
     def parseTrial(self, data):
-        q=[]
-        for i in range(0, len(data)):
-            q.append( self.dof2pinocchio(data[i][:]) )
+        ''' Q = parseTrial(data)
+        Convert a (T, 42) array of GX OpenSim generalized coordinates into a
+        (T, 49) array of Pinocchio configurations (see dof2pinocchio), for all
+        the frames at once.
+        '''
+        dof = np.asarray(data, dtype=np.float)
+        q = np.empty((dof.shape[0], 49))
+        q[:,0:3] = np.dot(dof[:,3:6], np.asarray(self.oMp).T)
+        for (iq, idof, sign) in self.OSIM_QUATERNIONS:
+            q[:,iq:iq+4] = self.eulerToQuaternion(sign[0]*dof[:,idof[0]],
+                                                  sign[1]*dof[:,idof[1]],
+                                                  sign[2]*dof[:,idof[2]])
+        for (iq, idof, n) in self.OSIM_COPIES:
+            q[:,iq:iq+n] = dof[:,idof:idof+n]
         return q
         
     def parseTrialVel(self, data):
-        dq=[]
-        for i in range(0, len(data)):
-            dq.append( self.vel2pinocchio(data[i][:]) )
+        ''' V = parseTrialVel(data)
+        Batch version of vel2pinocchio: (T, 42) array -> (T, 42) array
+        '''
+        dof = np.asarray(data, dtype=np.float)
+        dq = np.empty((dof.shape[0], 42))
+        dq[:,0:3] = np.dot(dof[:,0:3], np.asarray(self.oMp).T)
+        dq[:,3:6] = dof[:,0:3]
+        dq[:,6:42] = dof[:,6:42]
         return dq
 
-    def readOsim(self, filename):
+    def eulerToQuaternion(self, ai, aj, ak):
+        ''' Vectorized equivalent of quaternion_from_matrix(euler_matrix(ai, aj, ak, 'rxyz')),
+        i.e. of the rotation Rx(ai)*Ry(aj)*Rz(ak), for arrays of angles.
+        Returns a (T, 4) array in Pinocchio order (x, y, z, w) with w >= 0.
+        '''
+        cx, sx = np.cos(0.5*ai), np.sin(0.5*ai)
+        cy, sy = np.cos(0.5*aj), np.sin(0.5*aj)
+        cz, sz = np.cos(0.5*ak), np.sin(0.5*ak)
+        quat = np.column_stack((sx*cy*cz + cx*sy*sz,
+                                cx*sy*cz - sx*cy*sz,
+                                sx*sy*cz + cx*cy*sz,
+                                cx*cy*cz - sx*sy*sz))
+        quat[quat[:,3] < 0.] *= -1.
+        return quat
+
+    def readOsim(self, filename, cache=True):
+        ''' Parse a .mot (motion) or .sto (forces) OpenSim file.
+        If cache is True, the parsed arrays are stored in a binary cache next to
+        the file on the first load (see saveTrialCache), and later loads map them
+        in memory (read-only) instead of parsing the text file again.
+        '''
         extension = os.path.splitext(filename)[1]
+        if extension not in ('.mot', '.sto'):
+            print 'could not parse, do not know the extension:'
+            print extension
+            return
+        if cache:
+            trial = self.loadTrialCache(filename)
+            if trial is not None:
+                if extension == '.sto':
+                    return np.asmatrix(trial['data'])
+                for key in ('pinocchio_data', 'pinocchio_kine', 'time'):
+                    trial[key] = np.asmatrix(trial[key])
+                return trial
+        from models import osim_parser
         if extension == '.mot':
             print 'parsing motion data'
             trial = osim_parser.readOsim(filename)
@@ -108,29 +423,161 @@ class Wrapper():
             trial['pinocchio_data'] = np.asmatrix(self.parseTrial(trial['data'][:]))
             trial['pinocchio_kine'] = np.asmatrix(self.parseTrialVel(trial['data'][:]))
             trial['time'] = np.asmatrix(trial['time'][:])
+            if cache:
+                self.saveTrialCache(filename, trial)
             return trial
-        elif extension == '.sto':
+        else:
             print 'parsing force data'
             trial = np.asmatrix(osim_parser.readOsim(filename))
+            if cache:
+                self.saveTrialCache(filename, {'data': trial})
             return trial
-        else:
-            print 'could not parse, do not know the extension:'
-            print extension
-    
+
+    def trialCacheDir(self, filename):
+        return filename + '.cache'
+
+    def fileHash(self, filename):
+        sha = hashlib.sha1()
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha.update(chunk)
+        return sha.hexdigest()
+
+    def replaceFile(self, path, write):
+        ''' Call write(f) on a temporary file of the directory of path, then rename
+        it to path, so that concurrent readers (e.g. of a memory-mapped .npy file)
+        see either the previous file or the complete new one
+        '''
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            os.rename(tmp, path)
+        except:
+            os.remove(tmp)
+            raise
+
+    def saveTrialCache(self, filename, trial):
+        ''' Store the arrays of a parsed trial as .npy files in trialCacheDir(filename),
+        together with the hash and the mtime of the source file and the entries of
+        the trial that are not arrays. Every file is replaced atomically and the
+        metadata is written last, so that an interrupted write leaves an invalid
+        cache rather than a corrupted one.
+        '''
+        cache_dir = self.trialCacheDir(filename)
+        try:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            meta = {'hash': self.fileHash(filename),
+                    'mtime': os.path.getmtime(filename),
+                    'arrays': [],
+                    'others': {}}
+            for key, value in trial.items():
+                if isinstance(value, np.ndarray):
+                    self.replaceFile(os.path.join(cache_dir, key + '.npy'),
+                                     lambda f: np.save(f, np.asarray(value)))
+                    meta['arrays'].append(key)
+                else:
+                    meta['others'][key] = value
+            self.replaceFile(os.path.join(cache_dir, 'meta.pkl'),
+                             lambda f: pickle.dump(meta, f, pickle.HIGHEST_PROTOCOL))
+        except (IOError, OSError, pickle.PicklingError) as e:
+            print 'could not write the cache of %s: %s' % (filename, e)
+
+    def loadTrialCache(self, filename):
+        ''' Return the cached trial of filename with its arrays memory-mapped,
+        or None if there is no valid cache. The cache is valid if the source file
+        has the same mtime, or the same content hash, as when the cache was written.
+        '''
+        meta_file = os.path.join(self.trialCacheDir(filename), 'meta.pkl')
+        if not os.path.isfile(meta_file):
+            return None
+        try:
+            with open(meta_file, 'rb') as f:
+                meta = pickle.load(f)
+            mtime = os.path.getmtime(filename)
+            if meta['mtime'] != mtime:
+                if meta['hash'] != self.fileHash(filename):
+                    return None
+                meta['mtime'] = mtime
+                self.replaceFile(meta_file, lambda f: pickle.dump(meta, f, pickle.HIGHEST_PROTOCOL))
+            trial = dict(meta['others'])
+            for key in meta['arrays']:
+                trial[key] = np.load(os.path.join(self.trialCacheDir(filename), key + '.npy'), mmap_mode='r')
+            return trial
+        except (IOError, OSError, EOFError, KeyError, ValueError, pickle.UnpicklingError):
+            return None
+
 
         
-    def inverseDynamics(self, q, v, a, f_ext=None):
-        '''ID(q, v, a, f_ext)
-         f_ext: Vector of external forces expressed in the local frame of each joint 
-         do it recursively
-        '''
-        if f_ext is None:
-            for i in range(0, len(q)):
-                Tau.append(se3.rnea(self.model, self.data, q, v, a))
-        else:
-            for i in range(0, len(q)):
-                Tau.append(se3.rnea(self.model, self.data, q, v, a, f_ext))
-        return Tau
+    def inverseDynamicsChunk(self, Q, V, A, index, f_ext, out_file):
+        ''' Joint torques (n, nv) of a chunk of a trajectory; written in out_file if it is given '''
+        data = self.acquireData()
+        try:
+            n = len(Q)
+            if out_file is None:
+                Tau = np.empty((n, self.nv))
+            else:
+                Tau = np.load(out_file, mmap_mode='r+')[index[0]:index[0]+n]
+            fext = None
+            if f_ext is not None:
+                fext = se3.StdVec_Force()
+                for j in xrange(len(self.model.joints)):
+                    fext.append(se3.Force.Zero())
+            for i in xrange(n):
+                q = np.asmatrix(Q[i]).reshape(self.nq, 1)
+                v = np.asmatrix(V[i]).reshape(self.nv, 1)
+                a = np.asmatrix(A[i]).reshape(self.nv, 1)
+                if fext is None:
+                    Tau[i] = se3.rnea(self.model, data, q, v, a).A1
+                else:
+                    for j in xrange(len(fext)):
+                        fext[j] = se3.Force(np.asmatrix(f_ext[index[i], j]).reshape(6, 1))
+                    Tau[i] = se3.rnea(self.model, data, q, v, a, fext).A1
+            if out_file is not None:
+                Tau.flush()
+                return None
+            return Tau
+        finally:
+            self.releaseData(data)
+
+    def inverseDynamics(self, q, v, a, f_ext=None, processes=1, chunk_size=None, out_file=None):
+        '''Tau = ID(q, v, a, f_ext)
+         Joint torques (T, nv) along a trajectory of configurations (T, nq),
+         velocities (T, nv) and accelerations (T, nv).
+         f_ext: optional external wrenches (T, njoints, 6) [linear, angular], expressed
+                in the local frame of each joint (see alignForceData to resample the
+                rows of a .sto force file on the time of the motion)
+         processes, chunk_size: see mapTrajectory
+         out_file: if given, the torques are streamed chunk by chunk to this .npy file,
+                   which is returned memory-mapped
+        '''
+        T = len(q)
+        Q = np.asarray(q, np.float).reshape(T, self.nq)
+        V = np.asarray(v, np.float).reshape(T, self.nv)
+        A = np.asarray(a, np.float).reshape(T, self.nv)
+        if f_ext is not None:
+            f_ext = np.asarray(f_ext, np.float).reshape(T, len(self.model.joints), 6)
+        if out_file is not None:
+            # create the file, the chunks are written in it by the workers
+            np.lib.format.open_memmap(out_file, 'w+', np.float, (T, self.nv))
+        results = self.mapTrajectory('inverseDynamicsChunk', (Q, V, A, np.arange(T)), processes,
+                                     chunk_size, args=(f_ext, out_file))
+        if out_file is not None:
+            return np.load(out_file, mmap_mode='r')
+        return np.concatenate(results)
+
+    def alignForceData(self, force_time, force_data, time):
+        ''' Linearly resample the rows of force data (e.g. read from a .sto file),
+        sampled at force_time, on the time stamps of a motion. Returns (T, cols).
+        '''
+        force_time = np.asarray(force_time, np.float).ravel()
+        force_data = np.asarray(force_data, np.float).reshape(len(force_time), -1)
+        time = np.asarray(time, np.float).ravel()
+        aligned = np.empty((len(time), force_data.shape[1]))
+        for c in xrange(force_data.shape[1]):
+            aligned[:,c] = np.interp(time, force_time, force_data[:,c])
+        return aligned
 
     def forwardDynamics(self):
         pass
@@ -144,38 +591,50 @@ class Wrapper():
         return se3.differentiate(self.model, np.asmatrix(q1), np.asmatrix(q2))
         
     def generalizedVelocity(self, Q, dt):
-        return np.asmatrix( np.gradient(Q, dt) )
+        return np.asmatrix(self.trajectoryDerivatives(Q, dt)[0])
 
     def biais(self, q, v):
         ''' the coriolis, centrifugal and gravitational effects '''
-        return se3.nle(self.model, self.data, q, v)
+        return self.bias(q, v)
 
-    def bias(self, q, v, update_kinematics=True):
+    def bias(self, q, v, update_kinematics=True, data=None):
+        if data is not None:
+            if(update_kinematics):
+                se3.nle(self.model, data, q, v)
+            return data.nle
         if(update_kinematics):
-            return se3.nle(self.model, self.data, q, v)
-        return self.data.nle
+            self.setState(q, v)
+        self.require('nle')
+        return self.cache['nle']
 
     def generalizedAcceleration(self, V, dt):
-        return np.asmatrix(np.gradient(V, dt))
+        return np.asmatrix(np.gradient(np.asarray(V), dt, axis=0))
 
-    def velocity(self, q, v, index, update_kinematics=True):
+    def velocity(self, q, v, index, update_kinematics=True, data=None):
+        if data is None:
+            data = self.data
         if update_kinematics:
-            se3.forwardKinematics(self.model, self.data, q, v)
-        return self.data.v[index]
+            self.forwardKinematics(q, v, data=data)
+        return data.v[index]
 
-    def acceleration(self, q, v, a, index, update_acceleration=True):
+    def acceleration(self, q, v, a, index, update_acceleration=True, data=None):
+        if data is None:
+            data = self.data
         if update_acceleration:
-            se3.forwardKinematics(self.model, self.data, q, v, a)
-        return self.data.a[index]
+            self.forwardKinematics(q, v, a, data=data)
+        return data.a[index]
 
-    def forwardKinematics(self, q, v=None, a=None):
+    def forwardKinematics(self, q, v=None, a=None, data=None):
+        if data is None:
+            data = self.data
+            self.invalidate()
         if v is not None:
             if a is not None:
-                se3.forwardKinematics(self.model, self.data, q, v, a)
+                se3.forwardKinematics(self.model, data, q, v, a)
             else:
-                se3.forwardKinematics(self.model, self.data, q, v)
+                se3.forwardKinematics(self.model, data, q, v)
         else:
-            se3.forwardKinematics(self.model, self.data, q)
+            se3.forwardKinematics(self.model, data, q)
 
     def computeAllKinematics(self, Q):
         self.Q = Q
@@ -202,6 +661,7 @@ class Wrapper():
 
 
     def record(self, motion, variable, idx=None):
+        from bmtools.algebra import euler_from_matrix
         Jtask = []
         task = []
         if variable is 'joint':
@@ -231,24 +691,130 @@ class Wrapper():
 
         return task, Jtask
             
-    def kine(self, motion):
-        q = []
-        vel = []
-        #hg = []
-        for i in range(0, len(motion)):
-            se3.forwardKinematics(self.model, self.data, motion[i])
-            q.append(motion[i])
-            if i is 0:
-                vel.append(self.v0)
+    def lieGroupSegments(self):
+        ''' Group the joints by the Lie group of their configuration (see LIE_GROUPS):
+        'euclidean' (index arrays in q and v of the joints whose velocity is the
+        derivative of their configuration), 'freeflyer' and 'spherical' (lists of
+        (idx_q, idx_v)). Computed on first use, since only the trajectory
+        differentiation needs it.
+        '''
+        if self.lie_groups is not None:
+            return self.lie_groups
+        segments = {'euclidean': ([], []), 'freeflyer': [], 'spherical': []}
+        for i in range(1, len(self.model.joints)):
+            joint = self.model.joints[i]
+            group = self.LIE_GROUPS.get(joint.shortname(), None)
+            if group == 'euclidean':
+                segments['euclidean'][0].extend(range(joint.idx_q, joint.idx_q+joint.nq))
+                segments['euclidean'][1].extend(range(joint.idx_v, joint.idx_v+joint.nv))
+            elif group is not None:
+                segments[group].append((joint.idx_q, joint.idx_v))
             else:
-                vel.append(self.differentiate(q[i-1], q[i])/self.dt)
-        #filter
-        v=self.reshape(vel)
-        v_hat=self.filterM(v, cutoff=35, fs=400, order=4)
-        v_hat2 =self.reshape(v_hat)
-        #    se3.ccrba(self.model, self.data, q[i], vel[i])
-        #hg.append(self.data.hg)
-        return q, v_hat2
+                raise Exception('Joint %s (%s) is not supported by the trajectory differentiation'
+                                % (self.model.names[i], joint.shortname()))
+        segments['euclidean'] = (np.array(segments['euclidean'][0], np.int),
+                                 np.array(segments['euclidean'][1], np.int))
+        self.lie_groups = segments
+        return segments
+
+    def quaternionLog(self, quat0, quat1):
+        ''' Vectorized log3(R0^T*R1) for arrays of quaternions (..., 4) in Pinocchio
+        order (x, y, z, w). Returns the (..., 3) rotation vectors.
+        '''
+        v0, w0 = quat0[...,:3], quat0[...,3:]
+        v1, w1 = quat1[...,:3], quat1[...,3:]
+        # relative quaternion conj(quat0)*quat1, taken with w >= 0 (shortest rotation)
+        w = w0*w1 + np.sum(v0*v1, axis=-1)[...,np.newaxis]
+        v = w0*v1 - w1*v0 - np.cross(v0, v1)
+        sign = np.where(w < 0., -1., 1.)
+        w *= sign
+        v *= sign
+        s = np.sqrt(np.sum(v*v, axis=-1))[...,np.newaxis]
+        small = s < 1e-8
+        theta = 2.*np.arctan2(s, w)
+        return np.where(small, 2./np.maximum(w, 1e-8), theta/np.where(small, 1., s))*v
+
+    def se3Log(self, q0, q1):
+        ''' Vectorized log6(M0^-1*M1) for arrays of free-flyer configurations (..., 7)
+        [x, y, z, qx, qy, qz, qw]. Returns the (..., 6) twists [linear, angular].
+        '''
+        omega = self.quaternionLog(q0[...,3:], q1[...,3:])
+        # p = R0^T*(p1-p0), rotating by the conjugate of quat0
+        u, w = -q0[...,3:6], q0[...,6:]
+        x = q1[...,:3] - q0[...,:3]
+        ux = np.cross(u, x)
+        p = x + 2.*w*ux + 2.*np.cross(u, ux)
+        # linear part: V(omega)^-1*p
+        theta2 = np.sum(omega*omega, axis=-1)[...,np.newaxis]
+        theta = np.sqrt(theta2)
+        small = theta < 1e-4
+        theta_safe = np.where(small, 1., theta)
+        c = np.where(small, 1./12. + theta2/720.,
+                     (1. - theta_safe*np.sin(theta_safe)/(2.*(1.-np.cos(theta_safe))))/(theta_safe*theta_safe))
+        wp = np.cross(omega, p)
+        linear = p - 0.5*wp + c*np.cross(omega, wp)
+        return np.concatenate((linear, omega), axis=-1)
+
+    def trajectoryDifference(self, Q0, Q1):
+        ''' Vectorized se3.differentiate over the rows of two (T, nq) arrays of
+        configurations. Returns a (T, nv) array.
+        '''
+        segments = self.lieGroupSegments()
+        D = np.empty((Q0.shape[0], self.nv))
+        iq, iv = segments['euclidean']
+        D[:,iv] = Q1[:,iq] - Q0[:,iq]
+        for (iq, iv) in segments['freeflyer']:
+            D[:,iv:iv+6] = self.se3Log(Q0[:,iq:iq+7], Q1[:,iq:iq+7])
+        if len(segments['spherical']) > 0:
+            iq = np.array([range(i, i+4) for (i, _) in segments['spherical']])
+            iv = np.array([range(i, i+3) for (_, i) in segments['spherical']])
+            D[:,iv] = self.quaternionLog(Q0[:,iq], Q1[:,iq])
+        return D
+
+    def trajectoryDerivatives(self, Q, dt=None, method='central', cutoff=None, fs=None, order=4):
+        ''' V, A = trajectoryDerivatives(Q, dt, method, cutoff, fs, order)
+        Velocities and accelerations (T, nv) of a (T, nq) trajectory of configurations,
+        computed on the Lie group of each joint (free-flyer and spherical joints through
+        the log map of the relative displacement, not by differentiating the quaternions).
+        method: 'central' differences (one-sided at the ends), or 'backward' differences
+                with zero velocity and acceleration at the first frame
+        cutoff: if not None, the velocities are low-pass filtered (zero-phase Butterworth
+                of the given order) before computing the accelerations
+        '''
+        if dt is None:
+            dt = self.dt
+        Q = np.asarray(Q, np.float).reshape(len(Q), self.nq)
+        T = Q.shape[0]
+        V = np.zeros((T, self.nv))
+        A = np.zeros((T, self.nv))
+        if T < 2:
+            return V, A
+        if method == 'central':
+            V[0] = self.trajectoryDifference(Q[:1], Q[1:2])/dt
+            V[-1] = self.trajectoryDifference(Q[-2:-1], Q[-1:])/dt
+            V[1:-1] = self.trajectoryDifference(Q[:-2], Q[2:])/(2.*dt)
+        elif method == 'backward':
+            V[1:] = self.trajectoryDifference(Q[:-1], Q[1:])/dt
+        else:
+            raise ValueError('Unknown differentiation method: %s' % method)
+        if cutoff is not None:
+            V = self.filterM(V, cutoff, 1./dt if fs is None else fs, order)
+        if method == 'central':
+            A[0] = (V[1]-V[0])/dt
+            A[-1] = (V[-1]-V[-2])/dt
+            A[1:-1] = (V[2:]-V[:-2])/(2.*dt)
+        else:
+            A[1:] = (V[1:]-V[:-1])/dt
+        return V, A
+
+    def kine(self, motion, cutoff=35, fs=400, order=4):
+        ''' q, v = kine(motion)
+        Configurations and filtered (T, nv) velocities of a trajectory,
+        obtained by backward differences (see trajectoryDerivatives)
+        '''
+        q = [motion[i] for i in range(len(motion))]
+        v = self.trajectoryDerivatives(motion, self.dt, 'backward', cutoff, fs, order)[0]
+        return q, v
     
     def reshape(self, X):
         r,c = np.shape(X)[0:2]
@@ -259,44 +825,201 @@ class Wrapper():
                 X_hat[i,j] = xi[j]
         return X_hat
         
+    def filterBank(self, chunk_size=None):
+        from hqp.zero_phase_filter_bank import ZeroPhaseFilterBank
+        if chunk_size is not None:
+            return ZeroPhaseFilterBank(chunk_size)
+        if self.filter_bank is None:
+            self.filter_bank = ZeroPhaseFilterBank()
+        return self.filter_bank
+
     def filter(self, X, cutoff=10, fs=400, order=4):
-        X_hat = filtfilt_butter(X, cutoff, fs, order)
+        X_hat = self.filterBank().filter(np.asarray(X).squeeze(), cutoff, fs, order)
         return X_hat
 
 
-    def filterM(self, M, cutoff=10, fs=400, order=4):
-        t, dof = np.shape(M)[0:2]
-        M_hat = np.zeros((t,dof))
-        for i in xrange(dof):
-            M_hat[:,i] = filtfilt_butter(M[:,i], cutoff, fs, order)
-        return M_hat
-
-    def cam(self, q, vel):
-        hg = []
-        for i in range(0, len(q)):
-            se3.ccrba(self.model, self.data, q[i], vel[i])
-            hg.append(self.data.hg.copy())
-        return hg
-
-    def com(self, q, v=None, a=None, update_kinematics=True):
-        if v is not None:
+    def filterM(self, M, cutoff=10, fs=400, order=4, chunk_size=None, out=None):
+        ''' Zero-phase Butterworth filtering of all the columns of a (T, dof) matrix
+        at once. With chunk_size, the matrix is filtered chunk by chunk (the
+        result is the same), e.g. into a memory-mapped out for very long trials.
+        '''
+        return self.filterBank(chunk_size).filter(np.asarray(M), cutoff, fs, order, out)
+
+    def mapTrajectory(self, method, arrays, processes=None, chunk_size=None, min_chunk_size=50, args=()):
+        ''' results = mapTrajectory(method, arrays, processes, chunk_size)
+        Split the arrays along their first (time) axis into chunks and return the list
+        of the results of self.<method>(*(chunks + args)), in order. The chunks are processed
+        by a pool of forked processes, each one with its own copy of the model and
+        data, or sequentially if processes is 1.
+        processes: number of worker processes (None for the number of cores)
+        '''
+        T = len(arrays[0])
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        if chunk_size is None:
+            chunk_size = max(min_chunk_size, int(np.ceil(T/float(processes))))
+        bounds = [(i, min(i+chunk_size, T)) for i in range(0, T, chunk_size)]
+        if processes <= 1 or len(bounds) <= 1:
+            return [getattr(self, method)(*([a[i:j] for a in arrays] + list(args))) for (i, j) in bounds]
+        global trajectory_worker
+        trajectory_worker = (self, arrays, args)
+        pool = multiprocessing.Pool(min(processes, len(bounds)))
+        try:
+            return pool.map(runTrajectoryChunk, [(method, i, j) for (i, j) in bounds])
+        finally:
+            pool.close()
+            pool.join()
+            trajectory_worker = None
+
+    def camChunk(self, Q, V):
+        ''' Centroidal momenta (n, 6) of the frames of a chunk of a trajectory '''
+        data = self.acquireData()
+        try:
+            hg = np.empty((len(Q), 6))
+            for i in xrange(len(Q)):
+                se3.ccrba(self.model, data, np.asmatrix(Q[i]).reshape(self.nq, 1),
+                          np.asmatrix(V[i]).reshape(self.nv, 1))
+                hg[i] = data.hg.vector.A1
+            return hg
+        finally:
+            self.releaseData(data)
+
+    def cam(self, q, vel, dt=None, processes=None, chunk_size=None):
+        ''' hg, dhg = cam(q, vel)
+        Centroidal momentum hg (T, 6) [linear, angular] along a trajectory of
+        configurations q (T, nq) and velocities vel (T, nv), and its time derivative
+        dhg (T, 6) by central differences. The frames are split into chunks
+        processed in parallel (see mapTrajectory).
+        '''
+        if dt is None:
+            dt = self.dt
+        Q = np.asarray(q, np.float).reshape(len(q), self.nq)
+        V = np.asarray(vel, np.float).reshape(len(vel), self.nv)
+        hg = np.concatenate(self.mapTrajectory('camChunk', (Q, V), processes, chunk_size))
+        dhg = np.gradient(hg, dt, axis=0) if len(hg) > 1 else np.zeros_like(hg)
+        return hg, dhg
+
+    def recordFramesChunk(self, Q, index, frame_ids, jacobians, local_frame, jacobian_file):
+        ''' Poses (n, F, 7) and Jacobians (n, F, 6, nv) of the frames for a chunk of
+        a trajectory; the Jacobians are written in jacobian_file if it is given
+        '''
+        data = self.acquireData()
+        try:
+            n, F = len(Q), len(frame_ids)
+            poses = np.empty((n, F, 7))
+            J = None
+            if jacobians:
+                if jacobian_file is None:
+                    J = np.empty((n, F, 6, self.nv))
+                else:
+                    J = np.load(jacobian_file, mmap_mode='r+')[index[0]:index[0]+n]
+            for i in xrange(n):
+                q = np.asmatrix(Q[i]).reshape(self.nq, 1)
+                # computeJacobians also computes the joint placements oMi
+                if jacobians:
+                    se3.computeJacobians(self.model, data, q)
+                else:
+                    se3.forwardKinematics(self.model, data, q)
+                for k, f in enumerate(frame_ids):
+                    frame = self.model.frames[f]
+                    oMf = data.oMi[frame.parent] * frame.placement
+                    poses[i, k] = np.asarray(se3ToXYZQUAT(oMf)).ravel()
+                    if jacobians:
+                        J[i, k] = self.frameJacobian(q, f, False, local_frame, data=data)
+            if jacobian_file is not None:
+                if J is not None:
+                    J.flush()
+                return poses, None
+            return poses, J
+        finally:
+            self.releaseData(data)
+
+    def recordFrames(self, frame_ids, Q, jacobians=False, local_frame=True, jacobian_file=None,
+                     processes=1, chunk_size=None):
+        ''' poses, J = recordFrames(frame_ids, Q)
+        Record along a (T, nq) trajectory the poses (T, F, 7) [x, y, z, qx, qy, qz, qw]
+        of the F frames in frame_ids and, if jacobians is True, their Jacobians
+        (T, F, 6, nv) (local, or world-aligned if local_frame is False), with one
+        forward pass per time step for all the frames.
+        jacobian_file: if given, the Jacobians are written to this .npy file and
+                       returned memory-mapped, instead of being kept in memory
+        processes, chunk_size: see mapTrajectory
+        '''
+        T, F = len(Q), len(frame_ids)
+        Q = np.asarray(Q, np.float).reshape(T, self.nq)
+        if jacobians and jacobian_file is not None:
+            # create the file, the chunks are written in it by the workers
+            np.lib.format.open_memmap(jacobian_file, 'w+', np.float, (T, F, 6, self.nv))
+        results = self.mapTrajectory('recordFramesChunk', (Q, np.arange(T)), processes, chunk_size,
+                                     args=(list(frame_ids), jacobians, local_frame, jacobian_file))
+        poses = np.concatenate([r[0] for r in results])
+        if not jacobians:
+            return poses, None
+        if jacobian_file is not None:
+            return poses, np.load(jacobian_file, mmap_mode='r')
+        return poses, np.concatenate([r[1] for r in results])
+
+    def com(self, q, v=None, a=None, update_kinematics=True, data=None):
+        if data is not None:
+            if v is None:
+                return se3.centerOfMass(self.model, data, q)
             if a is None:
-                se3.centerOfMass(self.model, self.data, q, v)#, update_kinematics)
-                return self.data.com[0], self.data.vcom[0]
-            se3.centerOfMass(self.model, self.data, q, v, a)#, update_kinematics)
+                se3.centerOfMass(self.model, data, q, v)
+                return data.com[0], data.vcom[0]
+            se3.centerOfMass(self.model, data, q, v, a)
+            return data.com[0], data.vcom[0], data.acom[0]
+        if a is not None and np.any(a):
+            # the planner computes the CoM acceleration only for a = 0
+            self.invalidate()
+            se3.centerOfMass(self.model, self.data, q, v, a)
             return self.data.com[0], self.data.vcom[0], self.data.acom[0]
-        return se3.centerOfMass(self.model, self.data, q)#, update_kinematics)
+        if(update_kinematics):
+            self.setState(q, v)
+        self.require('com')
+        com, vcom, acom = self.cache['com']
+        if v is not None:
+            if a is None:
+                return com, vcom
+            return com, vcom, acom
+        return com
     
-    def Jcom(self, q): #, update_kinematics=True):
-        return se3.jacobianCenterOfMass(self.model, self.data, q)
-        #if(update_kinematics):
-        #    return se3.jacobianCenterOfMass(self.model, self.data, q)
-        #return self.data.Jcom
+    def Jcom(self, q, update_kinematics=True, data=None):
+        if data is not None:
+            return se3.jacobianCenterOfMass(self.model, data, q)
+        if(update_kinematics):
+            self.setState(q)
+        self.require('Jcom')
+        return self.cache['Jcom']
     
-    def mass(self, q, update_kinematics=True):
+    def mass(self, q, update_kinematics=True, data=None):
+        if data is not None:
+            if(update_kinematics):
+                se3.crba(self.model, data, q)
+            return data.M
+        if(update_kinematics):
+            self.setState(q)
+        self.require('M')
+        return self.cache['M']
+
+    def ccrba(self, q, v, update_kinematics=True, data=None):
+        ''' Centroidal momentum matrix Ag '''
+        if data is not None:
+            return se3.ccrba(self.model, data, q, v)
+        if(update_kinematics):
+            self.setState(q, v)
+        self.require('ccrba')
+        return self.cache['ccrba'][0]
+
+    def centroidalMomentum(self, q, v, update_kinematics=True, data=None):
+        ''' Centroidal momentum hg as a Force '''
+        if data is not None:
+            if(update_kinematics):
+                se3.ccrba(self.model, data, q, v)
+            return data.hg
         if(update_kinematics):
-            return se3.crba(self.model, self.data, q)
-        return self.data.M
+            self.setState(q, v)
+        self.require('ccrba')
+        return self.cache['ccrba'][1]
 
     def getDoF(self, jointName):
         idx = self.model.getJointId(jointName)
@@ -310,55 +1033,98 @@ class Wrapper():
         q_next = se3.integrate(self.model,q,dq)
         q[:] = q_next[:]
 
-    def jacobian(self, q, index, update_geometry=True, local_frame=True):
-        return se3.jacobian(self.model, self.data, q, index, local_frame, update_geometry)
+    def jacobian(self, q, index, update_geometry=True, local_frame=True, data=None):
+        if data is None:
+            data = self.data
+        return se3.jacobian(self.model, data, q, index, local_frame, update_geometry)
     
-    def computeJacobians(self, q):
-        return se3.computeJacobians(self.model, self.data, q)
+    def computeJacobians(self, q, data=None):
+        ''' Joint Jacobians for q. Without data they are computed through the update
+        planner (see setState), so that frameJacobian(..., update_geometry=False)
+        then reads them for q.
+        '''
+        if data is not None:
+            return se3.computeJacobians(self.model, data, q)
+        self.setState(q)
+        self.require('jacobians')
+        return self.cache['jacobians'][0]
 
     ''' Compute the placements of all the operational frames and put the results in data.
         To be called after forwardKinematics.
     '''
-    def framesKinematics(self, q):
-        se3.framesKinematics(self.model, self.data, q)
+    def framesKinematics(self, q, data=None):
+        se3.framesKinematics(self.model, self.data if data is None else data, q)
 
-    def framePosition(self, index, q=None):
+    def framePosition(self, index, q=None, data=None):
         f = self.model.frames[index]
         if q is not None:
-            se3.forwardKinematics(self.model, self.data, q)
-        return self.data.oMi[f.parent].act(f.placement)
+            self.forwardKinematics(q, data=data)
+        if data is None:
+            data = self.data
+        return data.oMi[f.parent].act(f.placement)
 
-    def frameVelocity(self, index):
+    def frameVelocity(self, index, data=None):
         f = self.model.frames[index]
-        return f.placement.actInv(self.data.v[f.parent])
+        if data is None:
+            data = self.data
+        return f.placement.actInv(data.v[f.parent])
         
     ''' Return the spatial acceleration of the specified frame. '''
-    def frameAcceleration(self, index):
+    def frameAcceleration(self, index, data=None):
         f = self.model.frames[index]
-        return f.placement.actInv(self.data.a[f.parent])
+        if data is None:
+            data = self.data
+        return f.placement.actInv(data.a[f.parent])
         
-    def frameClassicAcceleration(self, index):
+    def frameClassicAcceleration(self, index, data=None):
         f = self.model.frames[index]
-        a = f.placement.actInv(self.data.a[f.parent])
-        v = f.placement.actInv(self.data.v[f.parent])
+        if data is None:
+            data = self.data
+        a = f.placement.actInv(data.a[f.parent])
+        v = f.placement.actInv(data.v[f.parent])
         a.linear += np.cross(v.angular.T, v.linear.T).T
         return a;
-        ''' Call computeJacobians if update_geometry is true. 
-        If not, user should call computeJacobians first. 
-        Then call getJacobian and return the resulted jacobian matrix. 
-        Attention: if update_geometry is true,the function computes 
-        all the jacobians of the model. It is therefore outrageously 
-        costly wrt a dedicated call. Use only with update_geometry for prototyping.
-    '''
-    def frameJacobian(self, q, index, update_geometry=True, local_frame=True):
-	if local_frame:
-		return se3.frameJacobian(self.model, self.data, index, q)
-	else:
-		pass 
-		# idx = get parent joint index
-		# jointJacobian(q, idx)
-	
-       #return se3.frameJacobian(self.model, self.data, q, index, local_frame, update_geometry)
+
+    def frameJacobian(self, q, index, update_geometry=True, local_frame=True, data=None, out=None):
+        ''' Jacobian (6, nv) of the specified frame, expressed in the local frame if
+        local_frame is True, or in the world-aligned frame centered at the frame origin
+        otherwise. It is built from the joint Jacobians and placements computed by
+        computeJacobians, touching only the columns in the support of the frame (see
+        frameSupport). Without data they are taken from the update planner, after
+        setting its state to q if update_geometry is true (computeJacobians(q) does the
+        same); if update_geometry is false and the planner state is not q, they are read
+        in self.data, which must then be up to date. With data, computeJacobians is run
+        on it if update_geometry is true, otherwise data must be up to date.
+        out: optional (6, nv) matrix where the result is written
+        '''
+        frame = self.model.frames[index]
+        if data is None:
+            if update_geometry:
+                self.setState(q)
+            if self.state_q is not None and np.array_equal(q, self.state_q):
+                self.require('jacobians')
+                J_joints, oMi = self.cache['jacobians']
+            else:
+                J_joints, oMi = self.data.J, self.data.oMi
+        else:
+            if update_geometry:
+                se3.computeJacobians(self.model, data, q)
+            J_joints, oMi = data.J, data.oMi
+        oMf = oMi[frame.parent] * frame.placement
+        s = self.joint_supports[frame.parent]
+        J = np.matlib.zeros((6, self.nv)) if out is None else out
+        if out is not None:
+            J[:,:] = 0.
+        angular = J_joints[3:, s]
+        # linear velocity of the frame origin: v_O + w x p = v_O - p x w
+        linear = J_joints[:3, s] - np.cross(oMf.translation.T, angular.T).T
+        if local_frame:
+            R_T = oMf.rotation.T
+            linear = R_T * linear
+            angular = R_T * angular
+        J[:3, s] = linear
+        J[3:, s] = angular
+        return J
 
 
     def dof2pinocchio(self, dof):
@@ -384,6 +1150,7 @@ class Wrapper():
         rshoulder, relbow, rpro_sup, rwrist flexion, rwrist deviation, rfingers flexion 31..34, 35, 36, 37, 38, 39
         lshoulder, lelbow, lpro_sup, lwrist flexion, lwrist deviation, lfingers flexion 40..43, 44, 45, 46, 47, 48
         '''
+        from bmtools.algebra import quaternion_from_matrix, euler_matrix
         #Change OpenSim values to correpond to Pinocchio model
         pt = np.squeeze(np.array( self.oMp * np.matrix(dof[3:6]).T )) #tx,ty,tz
         pelvis = quaternion_from_matrix(euler_matrix((dof[0]),dof[1],dof[2],'rxyz'))
@@ -417,6 +1184,7 @@ class Wrapper():
 
     #test individual joints
     def move(self, name, dof):
+        from bmtools.filters import rpytoQUAT
         if name == 'pelvis_tilt':
             quat = rpytoQUAT(dof,se3.utils.npToTuple(self.q[1])[0],se3.utils.npToTuple(self.q[2])[0])
             self.q[3] = quat[0]
@@ -564,6 +1332,7 @@ class Wrapper():
     # utils
     def SphericalToRPY(joint):
         # i.e. SphericalToRPY('hip_r')
+        from bmtools.filters import pinocchioRobot
         i = pinocchioRobot.getDoFIdx(joint)  
         quat = np.matrix([ pinocchioRobot.q[i,0], pinocchioRobot.q[i+1,0],                            
                            pinocchioRobot.q[i+2,0], pinocchioRobot.q[i+3,0] ], np.float)  
@@ -740,6 +1509,7 @@ class Wrapper():
             return
 
     def play(self, q,v):            
+        from bmtools.filters import displayModel
         se3.forwardKinematics(self.model, self.data, q, v)
         displayModel(self.data, self.visuals)
         self.q = q            
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""
+Zero-phase (forward-backward) Butterworth filtering of multi-channel signals.
+
+The second-order sections of the filters are designed once per (cutoff, fs, order)
+and shared by all the filter banks. A (T, dof) signal is filtered along the time
+axis in a single call, optionally chunk by chunk with the filter state carried
+from one chunk to the next, so that signals too large for memory (e.g. stored
+in a np.memmap) can be filtered into a preallocated (possibly memory-mapped) output.
+The result is the same as scipy.signal.sosfiltfilt with its default odd padding.
+"""
+
+import numpy as np
+from scipy.signal import butter, sosfilt, sosfilt_zi, sosfiltfilt
+
+
+class ZeroPhaseFilterBank(object):
+
+    sos_cache = {};     # (cutoff, fs, order) -> second-order sections of the low-pass filter
+
+    ''' Constructor.
+        @param chunk_size Number of samples filtered at once (None to filter the whole signal at once)
+    '''
+    def __init__(self, chunk_size=None):
+        self.chunk_size = chunk_size;
+
+    ''' Return the second-order sections of the Butterworth low-pass filter, designing them
+        only the first time they are requested.
+    '''
+    def sos(self, cutoff, fs, order=4):
+        key = (float(cutoff), float(fs), int(order));
+        sos = self.sos_cache.get(key, None);
+        if(sos is None):
+            sos = butter(order, cutoff/(0.5*fs), btype='low', output='sos');
+            self.sos_cache[key] = sos;
+        return sos;
+
+    ''' Filter the (T, dof) signal X along the time axis, forward and backward.
+        @param out Optional preallocated (T, dof) output (e.g. a np.memmap), required to be
+                   different from X when filtering chunk by chunk
+    '''
+    def filter(self, X, cutoff, fs, order=4, out=None):
+        sos = self.sos(cutoff, fs, order);
+        squeeze = (np.ndim(X)==1);
+        if(squeeze):
+            X = np.asarray(X).reshape((-1,1));
+        Y = np.empty(X.shape) if out is None else out.reshape(X.shape);
+        if(self.chunk_size is None or X.shape[0]<=self.chunk_size):
+            Y[:] = sosfiltfilt(sos, np.asarray(X, np.float), axis=0);
+        else:
+            self.filterChunks(sos, X, Y);
+        if(out is not None):
+            return out;
+        return Y[:,0] if squeeze else Y;
+
+    ''' Forward-backward filtering of X into Y, chunk by chunk, with the same odd extension
+        at both ends and the same initial conditions as scipy.signal.sosfiltfilt.
+    '''
+    def filterChunks(self, sos, X, Y):
+        T = X.shape[0];
+        n = self.chunk_size;
+        zi0 = sosfilt_zi(sos)[:,:,np.newaxis];
+        ntaps = 2*sos.shape[0]+1 - min((sos[:,2]==0).sum(), (sos[:,5]==0).sum());
+        padlen = 3*ntaps;
+        if(T<=padlen):
+            raise ValueError("[ZeroPhaseFilterBank] ERROR: the signal must be longer than %d samples" % padlen);
+        x_first = np.asarray(X[0], np.float);
+        x_last  = np.asarray(X[T-1], np.float);
+        front = 2*x_first - np.asarray(X[padlen:0:-1], np.float);
+        back  = 2*x_last - np.asarray(X[T-padlen-1:T-1][::-1], np.float);
+
+        # forward pass: front extension, signal, back extension
+        (_, zi) = sosfilt(sos, front, axis=0, zi=zi0*front[0]);
+        for i in range(0, T, n):
+            (Y[i:i+n], zi) = sosfilt(sos, np.asarray(X[i:i+n], np.float), axis=0, zi=zi);
+        (y_back, zi) = sosfilt(sos, back, axis=0, zi=zi);
+
+        # backward pass, starting from the end of the back extension
+        (_, zi) = sosfilt(sos, y_back[::-1], axis=0, zi=zi0*y_back[-1]);
+        for i in range(((T-1)//n)*n, -1, -n):
+            (y, zi) = sosfilt(sos, np.asarray(Y[i:i+n][::-1]), axis=0, zi=zi);
+            Y[i:i+n] = y[::-1];
+        return Y;
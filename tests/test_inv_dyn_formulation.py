@@ -0,0 +1,109 @@
+''' End-to-end tests of InvDynFormulation.step on a small floating-base robot.
+    The robot only implements the part of the Wrapper interface that the formulation uses,
+    with constant (random) dynamics, so that the tests need neither a model file nor ospi.
+    Run with: python -m unittest discover tests
+'''
+import unittest
+import numpy as np
+import numpy.matlib
+
+try:    # needs pinocchio and qpoases
+    from hqp import inv_dyn_formulation_util
+    from hqp.inv_dyn_formulation_util import InvDynFormulation
+except ImportError:
+    inv_dyn_formulation_util = None
+
+
+class ConstantDynamicsRobot(object):
+    ''' Floating base with NA revolute joints, constant mass matrix and bias forces '''
+    NA = 4
+
+    def __init__(self, model_path=None, mesh_path=None, name='Robot', OsimModel=True):
+        rng = np.random.RandomState(0)
+        self.nq = self.NA+7
+        self.nv = self.NA+6
+        X = rng.randn(self.nv, self.nv)
+        self.M = np.matrix(np.dot(X, X.T) + self.nv*np.eye(self.nv))
+        self.h = np.matrix(rng.randn(self.nv, 1))
+        self.model = self
+        self.lowerPositionLimit = np.matrix(np.zeros((self.nq, 1))) - 2.0
+        self.upperPositionLimit = np.matrix(np.zeros((self.nq, 1))) + 2.0
+        self.velocityLimit = np.matrix(np.zeros((self.nv, 1))) + 10.0
+        self.effortLimit = np.matrix(np.zeros((self.nv, 1))) + 100.0
+
+    def setState(self, q, v=None):
+        pass
+
+    def require(self, *quantities):
+        pass
+
+    def com(self, q, update_kinematics=True):
+        return np.matrix([[0.0], [0.0], [1.0]])
+
+    def Jcom(self, q, update_kinematics=True):
+        return np.matrix(np.zeros((3, self.nv)))
+
+    def mass(self, q, update_kinematics=True):
+        return self.M
+
+    def bias(self, q, v, update_kinematics=True):
+        return self.h
+
+
+class JointAccelerationTask(object):
+    ''' Track the desired accelerations of the actuated joints '''
+    name = 'joint acceleration'
+
+    def __init__(self, nv, ddq_des):
+        na = ddq_des.shape[0]
+        self.J = np.matrix(np.zeros((na, nv)))
+        self.J[:, nv-na:] = np.matlib.eye(na)
+        self.ddq_des = ddq_des
+
+    def dyn_value(self, t, q, v, update_geometry=False):
+        return (self.J, np.matrix(np.zeros(self.ddq_des.shape)), self.ddq_des)
+
+
+@unittest.skipIf(inv_dyn_formulation_util is None, 'pinocchio and qpoases are required')
+class StepTest(unittest.TestCase):
+
+    def setUp(self):
+        self.Wrapper = inv_dyn_formulation_util.Wrapper
+        inv_dyn_formulation_util.Wrapper = ConstantDynamicsRobot
+        na = ConstantDynamicsRobot.NA
+        self.q = np.matrix(np.zeros((na+7, 1)))
+        self.q[6] = 1.0
+        self.v = np.matrix(np.zeros((na+6, 1)))
+        self.invdyn = InvDynFormulation('invdyn', self.q, self.v, 1e-3, None, None)
+        self.ddq_des = np.matrix(np.linspace(-1.0, 1.0, na)).T
+        self.invdyn.addTask(JointAccelerationTask(self.invdyn.nv, self.ddq_des), 1.0)
+
+    def tearDown(self):
+        inv_dyn_formulation_util.Wrapper = self.Wrapper
+
+    def checkSteps(self):
+        invdyn = self.invdyn
+        for i in range(3):
+            (tau, dv, f) = invdyn.step(i*invdyn.dt, self.q, self.v)
+            self.assertEqual(tau.shape, (invdyn.na, 1))
+            self.assertEqual(dv.shape, (invdyn.nv, 1))
+            self.assertEqual(f.shape, (0, 1))
+            # the joint accelerations are reachable with the torque limits
+            self.assertTrue(np.allclose(dv[6:], self.ddq_des, atol=1e-6))
+            self.assertTrue(np.allclose(invdyn.M*dv + invdyn.h, invdyn.S_T*tau, atol=1e-6))
+        self.assertEqual(invdyn.getStepTimings().shape, (3, len(invdyn.STEP_TIMING_STAGES)))
+
+    def test_step_cholesky(self):
+        self.checkSteps()
+
+    def test_step_projected(self):
+        self.invdyn.setDynamicsFormulation('projected')
+        self.checkSteps()
+
+    def test_step_direct(self):
+        self.invdyn.setDynamicsFormulation('direct')
+        self.checkSteps()
+
+
+if __name__ == '__main__':
+    unittest.main()
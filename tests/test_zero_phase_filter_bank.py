@@ -0,0 +1,43 @@
+''' Tests of ZeroPhaseFilterBank against scipy.signal.sosfiltfilt.
+    Run with: python -m unittest discover tests
+'''
+import unittest
+import numpy as np
+from scipy.signal import sosfiltfilt
+
+from hqp.zero_phase_filter_bank import ZeroPhaseFilterBank
+
+
+class ZeroPhaseFilterBankTest(unittest.TestCase):
+
+    def checkChunks(self, T, chunk_size, order=4):
+        X = np.random.RandomState(T).randn(T, 3)
+        bank = ZeroPhaseFilterBank(chunk_size)
+        Y = sosfiltfilt(bank.sos(10, 400, order), X, axis=0)
+        self.assertTrue(np.allclose(bank.filter(X, 10, 400, order), Y))
+        out = np.empty(X.shape)
+        self.assertTrue(bank.filter(X, 10, 400, order, out=out) is out)
+        self.assertTrue(np.allclose(out, Y))
+
+    def test_whole_signal(self):
+        self.checkChunks(100, None)
+
+    def test_chunks(self):
+        for chunk_size in (1, 7, 32, 99):
+            self.checkChunks(100, chunk_size)
+
+    def test_shortest_signal(self):
+        # order 4: two second-order sections, padlen = 15
+        self.checkChunks(16, 7)
+        self.assertRaises(ValueError, ZeroPhaseFilterBank(7).filter, np.zeros((15, 3)), 10, 400)
+
+    def test_vector(self):
+        x = np.random.RandomState(0).randn(50)
+        bank = ZeroPhaseFilterBank(8)
+        y = bank.filter(x, 10, 400)
+        self.assertEqual(y.shape, x.shape)
+        self.assertTrue(np.allclose(y, sosfiltfilt(bank.sos(10, 400), x)))
+
+
+if __name__ == '__main__':
+    unittest.main()